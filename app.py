@@ -1,6 +1,7 @@
-from celery import Celery
+from celery import Celery, chord, group
 import celery as clr
 from celery.result import AsyncResult
+from celery.signals import after_task_publish, task_prerun, task_postrun
 import socket
 import sys
 from src import *
@@ -25,88 +26,664 @@ celery.conf.update(
     task_serializer = CELERY_TASK_SERIALIZER,
     accept_content = CELERY_ACCEPT_CONTENT,
     result_serializer = CELERY_RESULT_SERIALIZER,
-    tasks_routes = CELERY_TASK_ROUTES,
+    task_routes = CELERY_TASK_ROUTES,
+    beat_schedule = CELERY_BEAT_SCHEDULE,
 )
 
-#### POST request task ########################################################################
+#### pipeline stages ########################################################################
 
-@celery.task(name = 'youtube_download', queue=QUEUE)
-def youtube_download_post(params):
+### prefetching of metadata of links by web tier (in background of request)
+prefetcher = ThreadPoolExecutor(max_workers = yt_opts['metadata']['prefetch_workers'])
+
+
+def prefetch_metadata(links: list = [], db_redis: object = None, logger: object = None):
+    """
+    asynchronous extraction of metadata of links into cache (for worker and planning of job)
+    """
+
+    meta = MetaCache(redisdb = db_redis, ttl = yt_opts['metadata']['ttl'], logger = logger)
+    for url in links:
+        if video_id(url): prefetcher.submit(meta.fetch, url)
+
+def job_limit(params: dict = {}) -> int:
+    """
+    max count of links of job: limit of request bounded by the cap from config
+    """
+
+    return min(params.get('limit') or yt_opts['playlist']['max_links'], yt_opts['playlist']['max_links'])
+
+
+def download_stage(params: dict = {}, timings: dict = {}, logger: object = None, cache: object = None,\
+                   progress: object = None, meta: object = None, failed: list = []) -> list:
+    """
+    downloading stage of job: failed links are added into failed,
+    as result - downloaded (or cached) files as (url, fpath, raw),
+    raw - the source is left for the stage of transcoding (out of download workers)
+    """
+
+    start, keys, files = time(), {}, []
+    codec = yt_opts['options']['postprocessors'][0]['preferredcodec']
+    ### with the stage of transcoding youtube_dl only downloads the source (the same profile for all bitrates)
+    transcode = yt_opts['transcode']['enabled']
+    options = {k:v for k,v in yt_opts['options'].items() if k != 'postprocessors'} if transcode else dict(yt_opts['options'])
+    if yt_opts['format_by_bitrate']:
+        options['format'] = audio_format(params['bitrate'], yt_opts['options']['format'])
+
+    def links():
+        """
+        links of job (with entries of playlists and channels as they are discovered),
+        files from local cache go straight to uploading
+        """
+        for url in expand_links(params['links'], params.get('offset', 0), job_limit(params), progress, failed):
+            progress.update(url, 'queued')
+            keys[url] = cache_key(url, params['bitrate']) if cache else None
+            fpath = cache.get(keys[url], link_dir(params['job'], url)) if keys[url] else None
+            if fpath is None:
+                yield url
+            else:
+                progress.update(url, 'downloaded', cached = True)
+                files.append((url, fpath, False))
+    #-------------------------------------------------------------------------------
+    try:
+        for url, fpath, timing in iter_download_audio(links(), main_dirs['DATA'],\
+                                                      num_workers = yt_opts['workers'], progress = progress,\
+                                                      codec = None if transcode else codec,\
+                                                      bitrate = None if transcode else params['bitrate'],\
+                                                      meta = meta, extra_info = {'job':params['job']}, **options):
+            if fpath is None:
+                failed.append(url)
+                progress.update(url, 'error')
+                log(logger, 'downloading', 'error', f"Some internal problem during execution : {url}")
+            else:
+                progress.update(url, 'downloaded')
+                timings['bytes_saved'] = timings.get('bytes_saved', 0) + timing.get('bytes_saved', 0)
+                log(logger, 'downloading', 'info', f"Received next file after execution : {fpath}, "
+                                                   f"saved by format {bytes2human(timing.get('bytes_saved', 0))}", timing)
+                if keys[url] and not transcode: cache.put(keys[url], fpath)
+                files.append((url, fpath, transcode))
+    except (Exception) as err:
+        log(logger, 'downloading', 'error', f"Exception during execution : {err}")
+    finally:
+        timings['download'] = round(time() - start, 3)
+
+    return files
+
+
+def transcode_stage(fetched: dict = {}, params: dict = {}, timings: dict = {}, logger: object = None,\
+                    cache: object = None, progress: object = None) -> list:
+    """
+    transcoding stage of job: downloaded sources are transcoded (or remuxed) by one ffmpeg process at once,
+    transcoded files are saved into local cache, failed sources are removed,
+    as result - transcoded files [(url, fpath), ...]
+    """
+
+    codec, files = yt_opts['options']['postprocessors'][0]['preferredcodec'], []
+    for url, fpath in fetched.get('raw', []):
+        progress.update(url, 'transcode')
+        try:
+            res = transcode_file(fpath, codec, params['bitrate'], yt_opts['transcode']['tolerance'])
+            timings['transcode'] = timings.get('transcode', 0) + res['seconds']
+            log(logger, 'transcoding', 'info', f"Transcoded {res['fpath']} by {res['mode']} in {res['seconds']} seconds", res)
+        except Exception as err:
+            progress.update(url, 'error')
+            remove_file(fpath)
+            log(logger, 'transcoding', 'error', f"Problem with transcoding of {url} : {err}")
+            continue
+        #-------------------------------------------------------------------------------
+        if cache and video_id(url): cache.put(cache_key(url, params['bitrate']), res['fpath'])
+        files.append((url, res['fpath']))
+
+    return files
+
+
+def cache_key(url: str = '', bitrate: str = '') -> str:
+    """
+    key of transcoded file of link in local cache (None for links out of youtube)
+    """
+
+    codec = yt_opts['options']['postprocessors'][0]['preferredcodec']
+
+    return AudioCache.make_key(video_id(url), codec, bitrate) if video_id(url) else None
+
+
+def stream_stage(params: dict = {}, timings: dict = {}, logger: object = None, cache: object = None,\
+                 progress: object = None, meta: object = None, db_redis: object = None, failed: list = []) -> tuple:
     """
-    simple procedure of async task for downloading audio from youtube
+    streaming stage of job without files on disk: the audio of video is transcoded by ffmpeg from url of format
+    into pipe and it is encrypted and uploaded to cloud by chunks at once (in workers by count of downloading),
+    links which are not streamed (cached, formats to be merged, failures of stream) are left for downloading,
+    as result - count of uploaded links and links for downloading
     """
+
+    start, rest = time(), []
+    codec = yt_opts['options']['postprocessors'][0]['preferredcodec']
+    options = {k:v for k,v in yt_opts['options'].items() if k != 'postprocessors'}
+    if yt_opts['format_by_bitrate']:
+        options['format'] = audio_format(params['bitrate'], yt_opts['options']['format'])
+    key, profile = option_profile(options, path_to_save = main_dirs['DATA'])
+    links = expand_links(params['links'], params.get('offset', 0), job_limit(params), progress, failed)
+    ### only codecs with constant bitrate have the size of stream known in advance,
+    ### otherwise the links are left lazy for downloading (playlists are expanded as they are downloaded)
+    if not codec_formats[codec].get('pipe') or not make_cloud(params, db_redis, logger).mkdir(params['fpath']):
+        return 0, links
+
+    def worker(url):
+        cloud = make_cloud(params, db_redis, logger)
+        progress.update(url, 'extract')
+        with downloaders.lease(key, profile) as (ydl, tracker):
+            source = stream_source(ydl, url, meta)
+        if source is None: return False
+        #-------------------------------------------------------------------------------
+        fname = sanitize(f"{os.path.splitext(source['fname'])[0]}.{codec_formats[codec]['ext']}")
+        with AudioStream(source['url'], source['headers'], codec, params['bitrate'], source['duration'],\
+                         yt_opts['stream']['slack_frames']) as stream:
+            progress.update(url, 'upload', bytes = 0, total = stream.size, speed = None, eta = None)
+            cloud.on_chunk = lambda done, total: progress.update(url, 'upload', bytes = done, total = total)
+            return cloud.upload_stream_to_cloud(fname, stream, stream.size)
+    #-------------------------------------------------------------------------------
+    def submit(pool, futures):
+        """
+        submitting of the next link for streaming (cached and unknown links are left for downloading)
+        """
+        for url in links:
+            progress.update(url, 'queued')
+            if not video_id(url) or (cache and cache.has(cache_key(url, params['bitrate']))):
+                rest.append(url)
+            else:
+                futures[pool.submit(worker, url)] = url
+                return
+    #-------------------------------------------------------------------------------
+    ### the next link is taken only when one of workers is free, so entries of playlists are expanded on the way
+    futures, uploaded = {}, 0
+    with ThreadPoolExecutor(max_workers = yt_opts['workers']) as pool:
+        for _ in range(yt_opts['workers']):
+            submit(pool, futures)
+        #---------------------------------------------------------------------------
+        while futures:
+            done, _ = wait(futures, return_when = FIRST_COMPLETED)
+            for future in done:
+                url = futures.pop(future)
+                try:
+                    go_on = future.result()
+                except Exception as err:
+                    go_on = False
+                    log(logger, 'streaming', 'error', f"Problem with streaming of {url} : {err}")
+                if go_on:
+                    uploaded += 1
+                    progress.update(url, 'done')
+                else:
+                    ### the links of formats in metadata could be expired - they are extracted again for downloading
+                    if meta: meta.delete(url)
+                    rest.append(url)
+                submit(pool, futures)
+    timings['stream'] = round(time() - start, 3)
+    log(logger, 'streaming', 'info', f"Streamed {uploaded} links, {len(rest)} links are left for downloading")
+
+    return uploaded, rest
+
+
+def link_dir(job: str = '', url: str = '') -> str:
+    """
+    folder of files of link in job (the same as in template of output of youtube_dl)
+    """
+
+    return os.path.join(main_dirs['DATA'], job, video_id(url))
+
+
+def remove_file(fpath: str = ''):
+    """
+    removing of file with its empty folders of link and job
+    """
+
+    if os.path.exists(fpath): os.remove(fpath)
+    path = os.path.dirname(fpath)
+    for _ in range(2):
+        if os.path.abspath(path) == os.path.abspath(main_dirs['DATA']): break
+        try:
+            os.rmdir(path)
+        except OSError:
+            break
+        path = os.path.dirname(path)
+
+
+def upload_stage(cloud: object = None, url: str = '', fpath: str = '', timings: dict = {}, progress: object = None) -> tuple:
+    """
+    uploading stage of job: renaming of file and uploading it to cloud,
+    as result - success and path of renamed file (it is kept for retry if uploading is failed)
+    """
+
+    start = time()
+    progress.update(url, 'rename')
+    ### clean from symbols, translit to english, clean from non english --
+    fpath_ = os.path.join(os.path.dirname(fpath), sanitize(os.path.basename(fpath)))
+
+    ### rename fpath -----------------------------------------------------
+    ### the file of retry could be renamed already
+    if fpath_ != fpath and os.path.exists(fpath): os.rename(fpath, fpath_)
+    cloud.log('renaming file', 'info', f'File renamed: {fpath_}')
+    timings['rename'] += time() - start
+
+    #---------------------------------------------------------------------
+    start = time()
+    progress.update(url, 'upload', bytes = 0, total = os.path.getsize(fpath_), speed = None, eta = None)
+    cloud.on_chunk = lambda done, total: progress.update(url, 'upload', bytes = done, total = total)
+    go_on = cloud.upload_file_to_cloud(fpath_)
+    timings['upload'] += time() - start
+    #---------------------------------------------------------------------
+    if go_on: 
+        remove_file(fpath_)
+        progress.update(url, 'done')
+        cloud.log('uploading file', 'info', f'Succeeded in uploading {fpath_} into {cloud.dir_name}')
+    else:
+        progress.update(url, 'error')
+        cloud.log('uploading file', 'error', f'Problem in uploading {fpath_} into {cloud.dir_name}')
     
-    go_on = False
-    ## Logging ################################################################################
+    return go_on, fpath_
+
+def make_cloud(params: dict = {}, db_redis: object = None, logger: object = None) -> object:
+    """
+    cloud connector with ledger and checkpoints of uploads in Redis
+    """
+
+    cloud = Cloudmega(
+        logger = logger,
+        username = configs['MEGACLOUD__USER'],
+        password = configs['MEGACLOUD__PASSW'],
+        ledger = db_redis,
+        checkpoints = db_redis,
+        chunked_min_bytes = yt_opts['cloud']['chunked_min_bytes'],
+        stat_ttl = yt_opts['cloud']['stat_ttl'],
+        index_ttl = yt_opts['cloud']['index_ttl'])
+    cloud.dir_name = params['fpath']
+
+    return cloud
+
+#### job tasks ##################################################################################
+
+def make_scheduler(db_redis: object = None, logger: object = None) -> object:
+    """
+    fair scheduler of jobs between users
+    """
+
+    return FairScheduler(
+        redisdb = db_redis,
+        capacity = configs['SCHED__CAPACITY'],
+        user_limit = configs['SCHED__USER_LIMIT'],
+        max_pending = configs['SCHED__MAX_PENDING'],
+        ttl = SLOT_TTL,
+        queue_ttl = JOB_TTL,
+        logger = logger)
+
+
+def make_progress(params: dict = {}, db_redis: object = None, logger: object = None) -> object:
+    """
+    progress of links of job
+    """
+
+    return JobProgress(redisdb = db_redis, user = params['user'], job = params['job'], logger = logger)
+
+
+def make_budget(db_redis: object = None, logger: object = None) -> object:
+    """
+    budget of scratch space of data volume
+    """
+
+    return DiskBudget(
+        redisdb = db_redis,
+        capacity = yt_opts['disk']['budget_bytes'],
+        path = main_dirs['DATA'],
+        headroom = yt_opts['disk']['headroom_bytes'],
+        ttl = yt_opts['disk']['reserve_ttl'],
+        stale = 3 * yt_opts['disk']['wait'],
+        logger = logger)
+
+
+def estimate_links(params: dict = {}, meta: object = None) -> int:
+    """
+    scratch footprint of links of job by metadata (by default size for unknown videos),
+    playlists and channels do not come here - they are expanded into jobs of entries
+    """
+
+    size = 0
+    for url in params['links']:
+        information = meta.fetch(url) if meta else None
+        size += (MetaCache.estimate(information, params['bitrate']) if information else None) or\
+                yt_opts['disk']['default_link_bytes']
+
+    return size
+
+
+def make_chain(params: dict = {}) -> object:
+    """
+    stages of link: downloading (queue of download workers) -> transcoding (queue of transcoding workers)
+    -> renaming and uploading (queue of upload workers)
+    """
+
+    return youtube_fetch.s(params) | youtube_transcode.s(params) | youtube_upload.s(params)
+
+
+def make_part(params: dict = {}) -> object:
+    """
+    signature of link of job: chain of stages, playlist or channel - expansion by batches
+    """
+
+    return youtube_expand.s(None, params) if is_collection(params['links'][0]) else make_chain(params)
+
+
+def make_job(params_links: list = [], params: dict = {}) -> object:
+    """
+    job as chord of chains of stages by links, playlists and channels are expanded by batches
+    into chains of their entries (they are added to the chord), the summary of job is made by callback
+    """
+
+    return chord(group([make_part(x) for x in params_links]), youtube_job.s(params))
+
+
+def send_job(params: dict = {}):
+    """
+    sending of job (chosen by scheduler) to Celery workers,
+    links of bulk job of API (parts with own bitrate and folder) are added to the chord by batches
+    """
+
+    if params.get('parts'):
+        head = {'user':params['user'], 'job':params['job']}
+        chord(group([youtube_expand.s(None, dict(head, parts = params['parts']))]), youtube_job.s(head))\
+            .apply_async(task_id = params['job'])
+    else:
+        make_job([dict(params, links = [url]) for url in params['links']], params).apply_async(task_id = params['job'])
+
+
+def job_finished(job: str = '') -> bool:
+    """
+    the callback of job (by id of job) is finished - with summary or by failure of chord
+    """
+
+    return AsyncResult(job, app = celery).ready()
+
+
+### slots of jobs are kept by their tasks: sent tasks are registered until they are started,
+### running tasks of stages renew the slot by heartbeat (the callback of job only releases it)
+job_stages = ['youtube_fetch', 'youtube_transcode', 'youtube_upload', 'youtube_expand']
+heartbeats = {}
+
+
+def job_params(args: object = None) -> dict:
+    """
+    params of job from arguments of task (params are the last argument of tasks of job) or None
+    """
+
+    params = args[-1] if isinstance(args, (list, tuple)) and args else None
+
+    return params if isinstance(params, dict) and 'job' in params and 'user' in params else None
+
+
+@after_task_publish.connect
+def track_task(sender: str = None, body: object = None, headers: dict = None, **kwargs):
+
+    params = job_params(body[0]) if isinstance(body, (list, tuple)) and body else None
+    if params:
+        make_scheduler(DBredis(topic = configs['REDIS__DB_STATUS'], host = REDIS_HOST, port = REDIS_PORT))\
+            .track(params['job'], headers['id'])
+
+
+@task_prerun.connect
+def start_heartbeat(task_id: str = None, task: object = None, args: object = None, **kwargs):
+
+    params = job_params(args)
+    if params is None: return
+    scheduler = make_scheduler(DBredis(topic = configs['REDIS__DB_STATUS'], host = REDIS_HOST, port = REDIS_PORT))
+    ### the slot is renewed before the task leaves the registry of sent tasks
+    if task.name in job_stages:
+        scheduler.renew_lease(params['user'], params['job'])
+        heartbeats[task_id] = LeaseHeartbeat(redisdb = scheduler, key = params['user'], token = params['job'], ttl = SLOT_TTL)
+        heartbeats[task_id].start()
+    scheduler.untrack(params['job'], task_id)
+
+
+@task_postrun.connect
+def stop_heartbeat(task_id: str = None, **kwargs):
+
+    heartbeat = heartbeats.pop(task_id, None)
+    if heartbeat: heartbeat.stop()
+
+
+def retry_countdown(retries: int = 0) -> float:
+    """
+    exponential backoff with jitter (the half of delay is random) for the next retry of stage
+    """
+
+    delay = min(yt_opts['retry']['cap'], yt_opts['retry']['base'] * 2 ** retries)
+
+    return round(delay / 2 + random.uniform(0, delay / 2), 3)
+
+
+def files_bytes(files: list = []) -> int:
+    """
+    bytes of files of job on disk [(url, fpath), ...]
+    """
+
+    return sum([os.path.getsize(fpath) for url, fpath in files if os.path.exists(fpath)])
+
+
+def add_timings(timings: dict = {}, other: dict = {}) -> dict:
+
+    return {k:round(timings.get(k, 0) + other.get(k, 0), 3) for k in set(timings) | set(other)}
+
+
+@celery.task(name = 'youtube_fetch', bind = True)
+def youtube_fetch(self, params, fetched = None):
+    """
+    the first stage of job: downloading of links (from cache if it is possible),
+    as result - ready files [(url, fpath), ...], sources for transcoding (raw) and timings for the next stages,
+    failed links are retried later by the same task (with files of previous tries in fetched)
+    """
+
     logger = logger_init(f"{datetime.now().strftime('%Y%W')}_youtube_download",\
                          main_dirs['LOGS'])
     log(logger, 'init task', 'warn', f"Received next params: {params}")
-    ## DB Redis instance ########################################################################
+    db_redis = DBredis(topic = configs['REDIS__DB_STATUS'], host = REDIS_HOST, port = REDIS_PORT)
+    db_redis.logger = logger
+    fetched = fetched or {'files':[], 'timings':{}, 'tries':0, 'reserve':make_guid(params['job'], *params['links'])}
+    progress = make_progress(params, db_redis, logger)
+    meta = MetaCache(redisdb = db_redis, ttl = yt_opts['metadata']['ttl'], logger = logger)
+    ### admission by disk space: the job which does not fit waits in the queue of budget (not longer than max_wait)
+    budget = make_budget(db_redis, logger)
+    size = estimate_links(params, meta)
+    admitted = budget.reserve(fetched['reserve'], size)
+    if admitted < 0 or (admitted == 0 and time() - fetched.setdefault('waiting', time()) > yt_opts['disk']['max_wait']):
+        for url in params['links']: progress.update(url, 'error', message = 'no disk space')
+        log(logger, 'reserving disk', 'error', f"No space for {bytes2human(size)} of {params['links']}, budget {bytes2human(budget.limit())}")
+        return dict(fetched, raw = [])
+    if admitted == 0:
+        countdown = round(yt_opts['disk']['wait'] * random.uniform(0.5, 1.5), 3)
+        for url in params['links']: progress.update(url, 'waiting', countdown = countdown)
+        log(logger, 'reserving disk', 'warn', f"No space for {bytes2human(size)} of {params['links']}, wait {countdown} seconds")
+        raise self.retry(kwargs = {'fetched':fetched}, countdown = countdown, max_retries = None)
+    reservation = LeaseHeartbeat(redisdb = budget, token = fetched['reserve'], ttl = budget.ttl, logger = logger)
+    reservation.start()
+    ##############################################################################################
+    files, timings, failed, streamed, params_ = [], {'download':0}, [], 0, params
     try:
-        db_redis = DBredis(
-            topic = configs['REDIS__DB_STATUS'],
-            host = REDIS_HOST,
-            port = REDIS_PORT,
-        )
-        go_on = db_redis.publish_message(params['key'], 'busy') 
+        cache = AudioCache(logger = logger, path_cache = main_dirs['CACHE'], max_bytes = yt_opts['cache']['max_bytes'])\
+                if yt_opts['cache']['enabled'] else None
+        ### streaming mode: only links which are not streamed are downloaded to disk
+        if yt_opts['stream']['enabled']:
+            streamed, links = stream_stage(params, timings, logger, cache, progress, meta, db_redis, failed)
+            params_ = dict(params, links = links, offset = 0, limit = None)
+        files = download_stage(params_, timings, logger, cache, progress, meta, failed)
     except Exception as err:
-        log(logger, 'init redis', 'error', f"Init redis during async task: {err}")
+        log(logger, 'running task', 'error', f"Exception during execution : {err}")
+    finally:
+        reservation.stop()
+    #---------------------------------------------------------------------
+    fetched = dict(fetched,
+                   files = fetched['files'] + [(url, fpath) for url, fpath, raw in files if not raw],
+                   raw = fetched.get('raw', []) + [(url, fpath) for url, fpath, raw in files if raw],
+                   uploaded = fetched.get('uploaded', 0) + streamed,
+                   timings = add_timings(fetched['timings'], timings))
+    ### only failed links are retried, the worker is free while waiting
+    if failed and fetched['tries'] < yt_opts['retry']['max_retries']:
+        countdown = retry_countdown(fetched['tries'])
+        fetched['tries'] += 1
+        for url in failed: progress.update(url, 'retry', countdown = countdown)
+        log(logger, 'retrying task', 'warn', f"Retry of {len(failed)} links in {countdown} seconds : {failed}")
+        raise self.retry(args = [dict(params, links = failed)], kwargs = {'fetched':fetched}, countdown = countdown,\
+                         max_retries = None)
+    #---------------------------------------------------------------------
+    if not fetched['files'] and not fetched['raw']: budget.release(fetched['reserve'])
+    else: budget.land(fetched['reserve'], files_bytes(fetched['files'] + fetched['raw']))
+
+    return fetched
+
+
+@celery.task(name = 'youtube_transcode')
+def youtube_transcode(fetched, params):
+    """
+    the stage of job between downloading and uploading: transcoding of downloaded sources
+    (by workers of transcoding queue - one ffmpeg process per core of host),
+    as result - fetched with transcoded files for the next stage
+    """
+
+    logger = logger_init(f"{datetime.now().strftime('%Y%W')}_youtube_download",\
+                         main_dirs['LOGS'])
+    db_redis = DBredis(topic = configs['REDIS__DB_STATUS'], host = REDIS_HOST, port = REDIS_PORT)
+    db_redis.logger = logger
+    if not fetched.get('raw'): return fetched
+    #---------------------------------------------------------------------
+    timings = {'transcode':0}
+    progress = make_progress(params, db_redis, logger)
+    budget = make_budget(db_redis, logger)
+    budget.renew_lease(token = fetched['reserve'])
+    cache = AudioCache(logger = logger, path_cache = main_dirs['CACHE'], max_bytes = yt_opts['cache']['max_bytes'])\
+            if yt_opts['cache']['enabled'] else None
+    files = transcode_stage(fetched, params, timings, logger, cache, progress)
+    budget.land(fetched['reserve'], files_bytes(fetched['files'] + files))
+
+    return dict(fetched, files = fetched['files'] + files, raw = [], timings = add_timings(fetched['timings'], timings))
+
+
+@celery.task(name = 'youtube_upload', bind = True)
+def youtube_upload(self, fetched, params):
+    """
+    the last stage of job: renaming and uploading of downloaded files to cloud,
+    failed files are retried later by the same task (with count of uploaded files in fetched)
+    """
+
+    logger = logger_init(f"{datetime.now().strftime('%Y%W')}_youtube_download",\
+                         main_dirs['LOGS'])
+    db_redis = DBredis(topic = configs['REDIS__DB_STATUS'], host = REDIS_HOST, port = REDIS_PORT)
+    db_redis.logger = logger
     ##############################################################################################
-    
-    if go_on:
-        ##### preparation by parameteres -----------------------------------------------
-        ## bitrate 
-        yt_opts['options']['postprocessors'][0]['preferredquality'] = str(params['bitrate'])
-        try:
-            result = download_audio(params['links'], main_dirs['DATA'], **yt_opts['options'])
-            if result == {}:
-                go_on = False
-                log(logger, 'downloading', 'error', f"Some internal problem during execution : {params['links']}")
-            else:
-                log(logger, 'downloading', 'info', f"Received next files after execution : {result.values()}")
-        except (Exception) as err:
-            log(logger, 'downloading', 'error', f"Exception during execution : {err}")
-    
-    if go_on:
-        ##### cloud connector init -----------------------------------------------------
-        cloud = Cloudmega(
-            logger = logger,
-            username = configs['MEGACLOUD__USER'],
-            password = configs['MEGACLOUD__PASSW'])
-        cloud.dir_name = params['fpath']
-        go_on = cloud.mkdir(params['fpath'])
-    
-    if go_on:
-        #-------------------------------------------------------------------------------
-        for _, fpath in result.items():
-            ### clean from symbols -----------------------------------------------
-            fpath_ = clean_string(fpath)
-            
-            ### translit to english ----------------------------------------------
-            fpath_ = translit(fpath_)
-
-            ### clean from non english symbols -----------------------------------
-            fpath_ = strip_non_english(fpath_).replace(' ', '_')
-
-            ### rename fpath -----------------------------------------------------
-            os.rename(fpath, fpath_)
-            cloud.log('renaming file', 'info', f'File renamed: {fpath_}')
-
-            #---------------------------------------------------------------------
-            for _ in range(2):
-                go_on = cloud.upload_file_to_cloud(fpath_)
-                if go_on: break
-                sleep(18)
-            #---------------------------------------------------------------------
-            os.remove(fpath_)
-            if go_on: 
-                cloud.log('uploading file', 'info', f'Succeeded in uploading {fpath_} into {cloud.dir_name}')
-            else:
-                cloud.log('uploading file', 'error', f'Problem in uploading {fpath_} into {cloud.dir_name}')
+    timings, uploaded, failed, start = {'rename':0, 'upload':0}, 0, [], time()
+    progress = make_progress(params, db_redis, logger)
+    budget = make_budget(db_redis, logger)
+    budget.renew_lease(token = fetched['reserve'])
+    try:
+        cloud = make_cloud(params, db_redis, logger)
+        cloud_ready = cloud.mkdir(params['fpath'])
+        if not cloud_ready:
+            log(logger, 'uploading', 'error', f"Problem with creating path : {params['fpath']}")
+        #-----------------------------------------------------------------
+        for url, fpath in fetched['files']:
+            size = os.path.getsize(fpath) if os.path.exists(fpath) else 0
+            go_on, fpath_ = upload_stage(cloud, url, fpath, timings, progress) if cloud_ready else (False, fpath)
+            uploaded += go_on
+            ### the space of uploaded (and removed) file goes back to budget
+            if go_on: budget.release(fetched['reserve'], size)
+            else: failed.append((url, fpath_))
+    except Exception as err:
+        failed.extend(fetched['files'][len(failed) + uploaded:])
+        log(logger, 'running task', 'error', f"Exception during execution : {err}")
+    #---------------------------------------------------------------------
+    timings['total'] = time() - start
+    fetched = dict(fetched, uploaded = fetched.get('uploaded', 0) + uploaded, timings = add_timings(fetched['timings'], timings))
+    ### only failed files are retried, the worker is free while waiting
+    if failed and self.request.retries < yt_opts['retry']['max_retries']:
+        countdown = retry_countdown(self.request.retries)
+        for url, _ in failed: progress.update(url, 'retry', countdown = countdown)
+        log(logger, 'retrying task', 'warn', f"Retry of uploading {len(failed)} files in {countdown} seconds")
+        raise self.retry(args = [dict(fetched, files = failed), params], countdown = countdown,\
+                         max_retries = yt_opts['retry']['max_retries'])
+    #---------------------------------------------------------------------
+    for url, fpath in failed:
+        progress.update(url, 'error')
+        remove_file(fpath)
+    budget.release(fetched['reserve'])
+    log(logger, 'pipeline timings', 'info', f"Stages of task for {params['links']} finished : {fetched['timings']}", fetched['timings'])
+
+    return {'links':params['links'], 'uploaded':fetched['uploaded'], 'timings':fetched['timings']}
+
+
+@celery.task(name = 'youtube_expand', bind = True)
+def youtube_expand(self, prior, params):
+    """
+    expansion of playlist or channel of job by batches: entries of batch are added to the chord of job
+    as own chains of stages as soon as they are discovered, the chain of the last entry continues
+    with expansion of the next batch (from offset), so not more than batch of entries is on disk at once
+    and uploading of the first entries goes on while the next ones are downloaded,
+    parts of bulk job of API (params of links) are added by batches in the same way,
+    prior - result of the chain before (it is passed to the chord as result of this task)
+    """
+
+    logger = logger_init(f"{datetime.now().strftime('%Y%W')}_youtube_download",\
+                         main_dirs['LOGS'])
+    db_redis = DBredis(topic = configs['REDIS__DB_STATUS'], host = REDIS_HOST, port = REDIS_PORT)
+    db_redis.logger = logger
+    progress = make_progress(params, db_redis, logger)
+    batch, limit, offset = yt_opts['playlist']['batch'], job_limit(params), params.get('offset', 0)
+    #---------------------------------------------------------------------
+    if params.get('parts'):
+        parts, more = params['parts'][:batch], dict(params, parts = params['parts'][batch:])
+        entries, chains = [x['links'][0] for x in parts], [make_part(x) for x in parts]
+        more = more if more['parts'] else None
     else:
-        log(logger, 'downloading', 'error', f"Problem with creating path : {params['fpath']}")
+        entries = list(expand_links(params['links'], offset, min(batch, limit), progress))
+        chains = [make_chain(dict(params, links = [url], offset = 0, limit = None)) for url in entries]
+        more = dict(params, offset = offset + batch, limit = limit - batch) if len(entries) == batch and limit > batch else None
+    if more and chains:
+        chains[-1] = chains[-1] | youtube_expand.s(more)
+    for url, sig in zip(entries, chains):
+        progress.update(url, 'queued')
+        self.add_to_chord(sig)
+    log(logger, 'expanding links', 'info', f"Added {len(entries)} entries of {params.get('links', 'bulk job')} from {offset} to job {params['job']}")
+
+    return prior or {'links':[], 'uploaded':0, 'timings':{}}
+
+
+@celery.task(name = 'youtube_job')
+def youtube_job(results, params):
+    """
+    callback of job: summary by all links, the progress of job is kept shortly, the slot of job (taken by scheduler) is released
+    """
+
+    logger = logger_init(f"{datetime.now().strftime('%Y%W')}_youtube_download",\
+                         main_dirs['LOGS'])
+    summary = {
+        'job':params['job'],
+        'links':sum([len(x.get('links', [])) for x in results if x]),
+        'uploaded':sum([x.get('uploaded', 0) for x in results if x]),
+    }
+    log(logger, 'job finished', 'info', f"Job {params['job']} finished : {summary}", summary)
+    #---------------------------------------------------------------------
+    db_redis = DBredis(topic = configs['REDIS__DB_STATUS'], host = REDIS_HOST, port = REDIS_PORT)
+    make_progress(params, db_redis, logger).finish()
+    scheduler = make_scheduler(db_redis, logger)
+    scheduler.release_lease(params['user'], params['job'])
+    scheduler.dispatch(send_job, job_finished)
+
+    return summary
 
-    go_on = db_redis.publish_message(params['key'], 'free')
+
+@celery.task(name = 'youtube_dispatch')
+def youtube_dispatch():
+    """
+    periodic dispatching of jobs (with reaping of slots of jobs which are failed without callback or lost)
+    """
+
+    logger = logger_init(f"{datetime.now().strftime('%Y%W')}_youtube_download",\
+                         main_dirs['LOGS'])
+    db_redis = DBredis(topic = configs['REDIS__DB_STATUS'], host = REDIS_HOST, port = REDIS_PORT)
+    make_scheduler(db_redis, logger).dispatch(send_job, job_finished)
 
 #########################################################################################################################
 
@@ -128,7 +705,8 @@ def index():
     
     ## Initialize variables ############################################
     #authorized, queue_free, int_token, set_cookie = False, False, None, False
-    app_engine = AppEngine(logger = logger, request = request, redisdb = db_redis)
+    app_engine = AppEngine(logger = logger, request = request, redisdb = db_redis,\
+                           scheduler = make_scheduler(db_redis, logger))
     
     #  Parsing cookie with internal token ------------------------------
     app_engine.auth_process(token = configs['APIBOT_TOKEN'])
@@ -160,37 +738,38 @@ def process_request():
                 port = REDIS_PORT)
     
     ### Initialize variables ###########################################
-    app_engine = AppEngine(logger = logger, request = request, redisdb = db_redis)
+    app_engine = AppEngine(logger = logger, request = request, redisdb = db_redis,\
+                           scheduler = make_scheduler(db_redis, logger))
 
     #  Parsing cookie with internal token ------------------------------
     app_engine.auth_process(main_page = False)
-    
-    #  check Redis status for queue availability -----------------------
-    if app_engine.authorized:
-        app_engine.check_status()
         
     ### Parsing POST params --------------------------------------------
     app_engine.parse_post_params()
     
-    if all([app_engine.parse_post, app_engine.queue_free]) and \
+    if all([app_engine.parse_post, app_engine.authorized]) and \
         app_engine.params_task['kind'] == 'youtube' and \
         not app_engine.uncorrect:
         app_engine.check_repeat_process(token = make_guid(app_engine.params_task))
+        #  adding job into the queue of user by one round trip ------------
+        app_engine.params_task['cost'] = job_cost(app_engine.params_task['links'], job_limit(app_engine.params_task))
         if app_engine.parse_post:
-            taskss = youtube_download_post.delay(app_engine.params_task)
-            task_id = taskss.id
-            if task_id: app_engine.queue_start = True
-            app_engine.log('Runing async task', 'info', f"Started task with task id {taskss.id} for {app_engine.params_task['kind']}.")
+            app_engine.enqueue_job()
+        else:
+            app_engine.check_status()
+        #---------------------------------------------------------------------
+        if app_engine.parse_post and app_engine.queue_free:
+            app_engine.queue_start = True
+            app_engine.log('Runing async task', 'info', f"Queued job {app_engine.params_task['job']} for {app_engine.params_task['kind']}.")
+            prefetch_metadata(app_engine.params_task['links'], db_redis, logger)
+            app_engine.scheduler.dispatch(send_job, job_finished)
+        elif app_engine.parse_post:
+            app_engine.log('trying async task', 'error', f"The queue is busy for {app_engine.params_task['kind']}.")
     #---------------------------------------------------------------------
-    elif app_engine.parse_post and \
-        app_engine.params_task['kind'] == 'youtube' and \
-        not app_engine.queue_free:
-        app_engine.log('trying async task', 'error', f"The queue is busy for {app_engine.params_task['kind']}.")
-    #---------------------------------------------------------------------
-    elif app_engine.parse_post and \
-        app_engine.params_task['kind'] == 'youtube' and \
-        not app_engine.uncorrect:
-        app_engine.log('trying async task', 'error', f"Some parameters are not correct for {app_engine.params_task['kind']}.")
+    elif app_engine.authorized:
+        app_engine.check_status()
+        if app_engine.parse_post and app_engine.params_task['kind'] == 'youtube':
+            app_engine.log('trying async task', 'error', f"Some parameters are not correct for {app_engine.params_task['kind']}.")
     
     #################################################################################################
 
@@ -199,5 +778,141 @@ def process_request():
     return app_engine.response
 
 
+@app.route('/queues', methods=['GET'])
+def queues():
+    """
+    depths of queues by users and reserved disk space for monitoring (access by token of API)
+    """
+
+    if request.args.get('token') != configs['APIBOT_TOKEN']:
+        return jsonify({'error':'unauthorized'}), 401
+    #---------------------------------------------------------------------
+    db_redis = DBredis(
+                topic = configs['REDIS__DB_STATUS'],
+                host = REDIS_HOST,
+                port = REDIS_PORT)
+
+    return jsonify(dict(make_scheduler(db_redis).depths(), disk = make_budget(db_redis).usage()))
+
+
+### waiting requests of /status (long polling and streams) - the rest of threads is kept for pages and API
+status_waiters = threading.BoundedSemaphore(STATUS_WAITERS)
+
+
+@app.route('/status', methods=['GET'])
+def status():
+    """
+    progress of jobs of user by links:
+    JSON with short long polling (since - the last seen version, wait - seconds)
+    or Server-Sent Events (opt-in by stream=1),
+    the request without free place of waiter is answered at once (stream - by 503 with Retry-After)
+    """
+
+    app_engine = AppEngine(request = request)
+    app_engine.auth_process(main_page = False)
+    if not app_engine.authorized:
+        return jsonify({'error':'unauthorized'}), 401
+    #---------------------------------------------------------------------
+    conn = DBredis(
+                topic = configs['REDIS__DB_STATUS'],
+                host = REDIS_HOST,
+                port = REDIS_PORT).client()
+    user = app_engine.int_token
+
+    ### Server-Sent Events: the stream is closed after STATUS_STREAM_TTL, browser reconnects by itself
+    if request.args.get('stream'):
+        try:
+            since = int(request.headers.get('Last-Event-ID', -1))
+        except ValueError:
+            since = -1
+        if not status_waiters.acquire(blocking = False):
+            return jsonify({'error':'too many waiting requests'}), 503, {'Retry-After':str(STATUS_WAIT)}
+
+        def events(since):
+            finish = time() + STATUS_STREAM_TTL
+            while time() < finish:
+                result = JobProgress.wait(conn, user, since, STATUS_WAIT)
+                if result['version'] > since:
+                    since = result['version']
+                    yield f"id: {since}\ndata: {json.dumps(result)}\n\n"
+                else:
+                    yield ": keep-alive\n\n"
+
+        response = Response(stream_with_context(events(since)), mimetype = 'text/event-stream',\
+                            headers = {'Cache-Control':'no-cache', 'X-Accel-Buffering':'no'})
+        response.call_on_close(status_waiters.release)
+        return response
+    #---------------------------------------------------------------------
+    since = request.args.get('since', -1, type = int)
+    wait = min(max(request.args.get('wait', 0, type = float), 0), STATUS_WAIT)
+    waiting = wait > 0 and status_waiters.acquire(blocking = False)
+    try:
+        return jsonify(JobProgress.wait(conn, user, since, wait if waiting else 0))
+    finally:
+        if waiting: status_waiters.release()
+
+
+@app.route('/api/jobs', methods=['POST'])
+def api_jobs():
+    """
+    bulk API (access by token of API): links with own bitrate and folder are queued as one job
+    of the user of API (with own weight) in the fair scheduler, links of job are sent by batches,
+    the id of job is returned immediately
+    """
+
+    if request.args.get('token') != configs['APIBOT_TOKEN']:
+        return jsonify({'error':'unauthorized'}), 401
+    #---------------------------------------------------------------------
+    logger = logger_init(f"{datetime.now().strftime('%Y%W')}_youtube_download",\
+                         main_dirs['LOGS'])
+    app_engine = AppEngine(logger = logger, request = request)
+    app_engine.parse_json_params(max_links = yt_opts['api']['max_links'])
+    if not app_engine.parse_post or app_engine.uncorrect:
+        return jsonify({'error':'incorrect parameters', 'max_links':yt_opts['api']['max_links'], 'bitrates':bitrates}), 400
+    #---------------------------------------------------------------------
+    db_redis = DBredis(topic = configs['REDIS__DB_STATUS'], host = REDIS_HOST, port = REDIS_PORT)
+    job = make_guid(API_USER, datetime.now(), random.random())
+    params_links = [{
+        'links':[x['url']],
+        'bitrate':x['bitrate'],
+        'fpath':x['fpath'],
+        'user':API_USER,
+        'job':job,
+    } for x in app_engine.params_task['links']]
+    scheduler = make_scheduler(db_redis, logger)
+    scheduler.set_weight(API_USER, yt_opts['api']['weight'])
+    if not scheduler.enqueue(API_USER, {'user':API_USER, 'job':job, 'parts':params_links,\
+                                        'cost':job_cost([x['links'][0] for x in params_links], yt_opts['api']['max_links'])}):
+        return jsonify({'error':'too many queued jobs of API'}), 429, {'Retry-After':'60'}
+    prefetch_metadata([x['links'][0] for x in params_links], db_redis, logger)
+    scheduler.dispatch(send_job, job_finished)
+    log(logger, 'api job', 'info', f"Queued job {job} with {len(params_links)} links")
+
+    return jsonify({'job':job, 'links':len(params_links)}), 202
+
+
+@app.route('/api/jobs/<job>', methods=['GET'])
+def api_job(job):
+    """
+    state of API job and progress of its links (access by token of API)
+    """
+
+    if request.args.get('token') != configs['APIBOT_TOKEN']:
+        return jsonify({'error':'unauthorized'}), 401
+    #---------------------------------------------------------------------
+    conn = DBredis(
+                topic = configs['REDIS__DB_STATUS'],
+                host = REDIS_HOST,
+                port = REDIS_PORT).client()
+    result = AsyncResult(job, app = celery)
+
+    return jsonify({
+        'job':job,
+        'state':result.state,
+        'result':result.result if result.successful() else None,
+        'links':JobProgress.read_job(conn, job),
+    })
+
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=configs['API_PORT'], debug = True)
\ No newline at end of file
@@ -0,0 +1,89 @@
+"""
+listing of folder of cloud on the synthetic tree of files (result of get_files) with 100k nodes:
+old - scan of all nodes by json_extract (4 recursive calls by node) as it was before NodeIndex,
+new - building of NodeIndex by one pass and iter_listdir / listdir of Cloudmega over the content of folder
+
+    python benchmarks/bench_listdir.py [--nodes 100000] [--folders 1000]
+
+the tree is given to Cloudmega instead of request to cloud, so only the pure-Python parts are measured
+"""
+
+import os
+import sys
+import random
+import argparse
+from time import perf_counter
+from datetime import datetime
+from psutil._common import bytes2human
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.utils import Cloudmega
+
+
+def make_tree(nodes: int = 0, folders: int = 0) -> tuple:
+    """
+    tree of nodes in the format of get_files: root, folders 'music/<n>' and files spread by folders,
+    result - (files, name of listed folder)
+    """
+
+    rnd = random.Random(0)
+    files = {'root':{'h':'root', 'p':'', 't':2, 'a':False, 'ts':0}}
+    files['music'] = {'h':'music', 'p':'root', 't':1, 'a':{'n':'music'}, 'ts':0, 'k':(0,)*4}
+    for n in range(folders):
+        files[f"d{n}"] = {'h':f"d{n}", 'p':'music', 't':1, 'a':{'n':str(n)}, 'ts':0, 'k':(0,)*4}
+    for n in range(nodes - folders - 2):
+        files[f"f{n}"] = {'h':f"f{n}", 'p':f"d{rnd.randrange(folders)}", 't':0, 's':rnd.randrange(1, 10**8),
+                          'a':{'n':f"track_{n}.mp3"}, 'ts':rnd.randrange(10**9, 17*10**8), 'k':(0,)*8, 'iv':(0,)*4}
+
+    return files, 'music/0'
+
+
+def old_listing(cloud: object = None, files: dict = {}, dir_id: str = '') -> list:
+    """
+    the scan of all tree as it was (without cost of DataFrame.append by row)
+    """
+
+    rows = []
+    for k,v in files.items():
+        try:
+            if dir_id in cloud.json_extract(v, 'p'):
+                if cloud.start_fdate <= datetime.fromtimestamp(cloud.json_extract(v, 'ts')[0]) <= cloud.end_fdate:
+                    rows.append({'fname':cloud.json_extract(v, 'n')[0],
+                                 'size':bytes2human(cloud.json_extract(v, 's')[0]),
+                                 'fdate':datetime.fromtimestamp(cloud.json_extract(v, 'ts')[0])})
+        except:
+            None
+
+    return rows
+
+
+def timed(name: str = '', func: object = None) -> object:
+
+    start = perf_counter()
+    result = func()
+    print(f"{name:<38}{perf_counter() - start:>8.3f} s")
+
+    return result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type = int, default = 100000)
+    parser.add_argument('--folders', type = int, default = 1000)
+    args = parser.parse_args()
+    #---------------------------------------------------------------------------------------------
+    files, dir_name = make_tree(args.nodes, args.folders)
+    cloud = Cloudmega(dir_name = dir_name)
+    cloud.conn, cloud.session = True, {}
+    cloud.request = lambda func: files
+    cloud.prepare_dates()
+    #---------------------------------------------------------------------------------------------
+    old = timed('old (json_extract scan)', lambda: old_listing(cloud, files, 'd0'))
+    index = timed('new: build of NodeIndex', cloud.nodes)
+    new = timed('new: iter_listdir of folder', lambda: list(cloud.iter_listdir()))
+    timed('new: listdir (DataFrame, gc.collect)', cloud.listdir)
+    #---------------------------------------------------------------------------------------------
+    key = lambda row: (row['fdate'], row['fname'])
+    assert sorted(old, key = key) == sorted(new, key = key), 'listings differ'
+    print(f"files in {dir_name}: {len(new)} of {len(files)} nodes")
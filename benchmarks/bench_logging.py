@@ -0,0 +1,113 @@
+"""
+overhead of logging by request (us/request), one request = logger_init and 4 info + 4 debug calls with level info:
+old - reload of logging, basicConfig and synchronous writes of file on every request (as before the change),
+new - logger_init of src.utils (logger of process, writing by listener thread of queue)
+
+    python benchmarks/bench_logging.py [--requests 2000]
+
+every variant runs in own process, because reload of logging in old variant changes the module for the whole process
+"""
+
+import os
+import sys
+import json
+import socket
+import logging
+import argparse
+import tempfile
+import multiprocessing
+from time import perf_counter
+from importlib import reload
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def old_logger_init(service_name: str = '', log_path: str = os.getcwd(), log_level: str = 'info') -> object:
+    """
+    initialization of logger as it was on every request
+    """
+
+    reload(logging)
+    service_name = service_name if service_name != '' else socket.gethostname()
+
+    logging.basicConfig(
+            filename = os.path.join(log_path, f'{service_name}.log'),
+            level = logging.INFO if log_level == 'info' \
+                    else logging.ERROR if log_level == 'error' \
+                    else logging.WARN if log_level == 'warn' \
+                    else logging.DEBUG,
+        )
+    return logging.getLogger(service_name)
+
+
+def old_log(logger: object = None, tag: str = 'action-service', log_level: str = 'info', message: str = '', data: dict = {}):
+    """
+    logging as it was: the record is encoded for every level
+    """
+
+    log_levels = ["debug", "info", "warn", "error"]
+    if log_levels.index(log_level) >= log_levels.index(log_level) and logger:
+        log_info = {
+            "level": log_level,
+            "time": datetime.now(timezone.utc).isoformat(),
+            "tag": tag,
+            "message": message,
+        }
+        log_info.update(data)
+
+        if log_level == 'info': logger.info(json.dumps(log_info))
+        elif log_level == 'debug':logger.debug(json.dumps(log_info))
+
+
+def request(init: object = None, log: object = None, log_path: str = '', i: int = 0):
+    """
+    logging of one request of app
+    """
+
+    logger = init('bench', log_path, 'info')
+    for n in range(4):
+        log(logger, 'request', 'info', f"request {i} step {n}", {'user':'bench', 'url':'https://youtu.be/x'})
+        log(logger, 'request', 'debug', f"request {i} details {n}", {'user':'bench', 'headers':{'accept':'*/*'}})
+
+
+def run(variant: str = '', requests: int = 0) -> tuple:
+    """
+    time of requests by variant (and time of flushing of queue for new variant)
+    """
+
+    with tempfile.TemporaryDirectory() as log_path:
+        if variant == 'old':
+            init, log, flush = old_logger_init, old_log, lambda: None
+        else:
+            from src.utils import logger_init, log, stop_loggers
+            init, flush = logger_init, stop_loggers
+        #-----------------------------------------------------------------------------------------
+        start = perf_counter()
+        for i in range(requests):
+            request(init, log, log_path, i)
+        per_request = (perf_counter() - start) / requests * 1e6
+        start = perf_counter()
+        flush()
+        flushing = perf_counter() - start
+        #-----------------------------------------------------------------------------------------
+        with open(os.path.join(log_path, 'bench.log')) as f:
+            lines = sum(1 for _ in f)
+
+    return per_request, flushing, lines
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type = int, default = 2000)
+    args = parser.parse_args()
+    #---------------------------------------------------------------------------------------------
+    ctx = multiprocessing.get_context('spawn')
+    result = {}
+    for variant in ['old', 'new']:
+        with ctx.Pool(1) as pool:
+            result[variant] = pool.apply(run, (variant, args.requests))
+        per_request, flushing, lines = result[variant]
+        print(f"{variant:<6}{per_request:>10.0f} us/request   lines of log: {lines}   flushing of queue: {flushing:.2f} s")
+    print(f"speedup x{result['old'][0] / result['new'][0]:.1f}")
@@ -0,0 +1,78 @@
+"""
+ops/sec of typical access of tasks to Redis (write of hash with ttl and reading of its fields by new instance):
+old - new connection by every instance with writing of static keys on every connect (as before pooling),
+new - DBredis on the pool of process with static keys written once
+
+    python benchmarks/bench_redis_pool.py [--host localhost] [--port 6379] [--ops 5000] [--fake]
+
+--fake runs both variants on in-process fakeredis (without costs of TCP connections - only overhead of client)
+"""
+
+import os
+import sys
+import argparse
+from time import perf_counter
+import redis
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src import utils
+from src.utils import DBredis
+
+
+def old_op(make_client: object = None, i: int = 0):
+    """
+    one operation as it was before pooling: connection by instance, static keys and separate round trips
+    """
+
+    conn = make_client()
+    conn.set('timezone', 'Europe/Moscow')
+    conn.hset(f"bench_{i % 100}", mapping = {'stage':'upload', 'bytes':i})
+    conn.expire(f"bench_{i % 100}", 60)
+    conn = make_client()
+    conn.set('timezone', 'Europe/Moscow')
+    conn.hmget(f"bench_{i % 100}", ['stage', 'bytes'])
+
+
+def new_op(host: str = '', port: int = 6379, i: int = 0):
+    """
+    the same operation by DBredis on the pool of process
+    """
+
+    DBredis(topic = 0, host = host, port = port).publish_fields(f"bench_{i % 100}", {'stage':'upload', 'bytes':i}, ttl = 60)
+    DBredis(topic = 0, host = host, port = port).reading_fields(f"bench_{i % 100}", ['stage', 'bytes'])
+
+
+def run(name: str = '', func: object = None, ops: int = 0) -> float:
+
+    start = perf_counter()
+    for i in range(ops):
+        func(i)
+    rate = ops / (perf_counter() - start)
+    print(f"{name:<28}{rate:>12.0f} ops/sec")
+
+    return rate
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default = 'localhost')
+    parser.add_argument('--port', type = int, default = 6379)
+    parser.add_argument('--ops', type = int, default = 5000)
+    parser.add_argument('--fake', action = 'store_true')
+    args = parser.parse_args()
+    #---------------------------------------------------------------------------------------------
+    if args.fake:
+        import fakeredis
+        server = fakeredis.FakeServer()
+        make_client = lambda: redis.StrictRedis(connection_pool = redis.ConnectionPool(
+                                connection_class = fakeredis.FakeConnection, server = server, decode_responses = True))
+        ### the pool of process is the same as DBredis makes, but on fake connections
+        utils.redis_pools[(args.host, args.port, 0, '')] = redis.ConnectionPool(
+                                connection_class = fakeredis.FakeConnection, server = server, decode_responses = True)
+    else:
+        make_client = lambda: redis.StrictRedis(host = args.host, port = args.port, db = 0, decode_responses = True)
+    #---------------------------------------------------------------------------------------------
+    old = run('old (connection by instance)', lambda i: old_op(make_client, i), args.ops)
+    new = run('new (pool of process)', lambda i: new_op(args.host, args.port, i), args.ops)
+    print(f"speedup x{new / old:.1f}")
@@ -0,0 +1,93 @@
+"""
+time of renaming of files by title (us/title):
+old - chain of clean_string, translit, strip_non_english and replace(' ', '_') as it was before precompiled tables,
+new - sanitize and sanitize_many of src.utils
+
+    python benchmarks/bench_sanitize.py [--titles 2000] [--length 240]
+"""
+
+import os
+import re
+import sys
+import random
+import argparse
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.utils import clean_string, sanitize, sanitize_many, upper_case_letters, lower_case_letters
+
+
+def old_translit(s: str = '') -> str:
+    """
+    translit from cyrillic to english as it was (dicts by call and growing of string by characters)
+    """
+
+    upper, lower = dict(upper_case_letters), dict(lower_case_letters)
+    translit_string = ""
+    for index, char in enumerate(s):
+        if char in lower.keys():
+            char = lower[char]
+        elif char in upper.keys():
+            char = upper[char]
+            if len(s) > index+1:
+                if s[index+1] not in lower.keys():
+                    char = char.upper()
+            else:
+                char = char.upper()
+        #---------------------------------------------------
+        translit_string += char
+
+    return translit_string
+
+
+def old_strip_non_english(s: str = '') -> str:
+    """
+    filtering of CJK letters as it was (checking of every character by list)
+    """
+
+    en_list = re.findall(u'[^一-龥]', s)
+
+    return ''.join(['' if c not in en_list else c for c in s])
+
+
+def old_sanitize(s: str = '') -> str:
+
+    return old_strip_non_english(old_translit(clean_string(s))).replace(' ', '_')
+
+
+def make_titles(count: int = 0, length: int = 0) -> list:
+    """
+    synthetic titles of Cyrillic, CJK, latin letters, digits and symbols removed by clean_string
+    """
+
+    rnd = random.Random(0)
+    alphabet = (list(upper_case_letters) + list(lower_case_letters) * 3 + [chr(c) for c in range(0x4E00, 0x4E80)]
+                + list('abcXYZ0123456789') + [' '] * 12 + list('!@#«$»&-.()'))
+
+    return [''.join(rnd.choice(alphabet) for _ in range(length)) for _ in range(count)]
+
+
+def run(name: str = '', func: object = None, titles: list = []) -> float:
+
+    start = perf_counter()
+    func(titles)
+    per_title = (perf_counter() - start) / len(titles) * 1e6
+    print(f"{name:<16}{per_title:>10.1f} us/title")
+
+    return per_title
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--titles', type = int, default = 2000)
+    parser.add_argument('--length', type = int, default = 240)
+    args = parser.parse_args()
+    #---------------------------------------------------------------------------------------------
+    titles = make_titles(args.titles, args.length)
+    assert [old_sanitize(s) for s in titles] == sanitize_many(titles), 'names differ from the old chain'
+    #---------------------------------------------------------------------------------------------
+    old = run('old chain', lambda ls: [old_sanitize(s) for s in ls], titles)
+    run('sanitize', lambda ls: [sanitize(s) for s in ls], titles)
+    new = run('sanitize_many', sanitize_many, titles)
+    print(f"speedup x{old / new:.1f}")
@@ -1,2 +1,8 @@
 from .utils import *
-from .youtube_download import *
\ No newline at end of file
+from .youtube_download import *
+from .cache import *
+from .scheduler import *
+from .progress import *
+from .transcode import *
+from .metadata import *
+from .budget import *
\ No newline at end of file
@@ -0,0 +1,226 @@
+from .utils import *
+import shutil
+
+
+#####################################################################################################
+#### Admission control by disk space
+#####################################################################################################
+
+### atomic reservation of bytes: expired reservations and stale waiters are dropped, the existing reservation
+### is prolonged, the new one is added only if it fits and there are no older waiters (FIFO),
+### the space for reservations is free space of volume (without headroom) with bytes which reserved jobs
+### have on disk already (not more than their reservations) - they are taken from free space and counted in reservations,
+### otherwise the token waits in the queue (0) or it is rejected if it does not fit even into the empty budget (-1)
+lua_reserve_disk = """
+local expired = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[4])
+for _, member in ipairs(expired) do
+    redis.call('hdel', KEYS[2], member)
+    redis.call('hdel', KEYS[5], member)
+end
+redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[4])
+if redis.call('hexists', KEYS[2], ARGV[1]) == 1 then
+    redis.call('zadd', KEYS[1], ARGV[5], ARGV[1])
+    return 1
+end
+for _, member in ipairs(redis.call('zrange', KEYS[3], 0, -1)) do
+    if tonumber(redis.call('hget', KEYS[4], member) or 0) < tonumber(ARGV[4]) - tonumber(ARGV[6]) then
+        redis.call('zrem', KEYS[3], member)
+        redis.call('hdel', KEYS[4], member)
+    end
+end
+local total, landed, credit = 0, 0, 0
+local reserved = redis.call('hgetall', KEYS[2])
+for i = 1, #reserved, 2 do
+    local bytes = tonumber(reserved[i + 1])
+    local written = tonumber(redis.call('hget', KEYS[5], reserved[i]) or 0)
+    total = total + bytes
+    landed = landed + written
+    credit = credit + math.min(bytes, written)
+end
+local size, limit, empty, capacity = tonumber(ARGV[2]), tonumber(ARGV[3]) + credit, tonumber(ARGV[3]) + landed, tonumber(ARGV[7])
+if capacity > 0 then
+    limit = math.min(limit, capacity)
+    empty = math.min(empty, capacity)
+end
+local since = redis.call('zscore', KEYS[3], ARGV[1])
+local older = since and redis.call('zcount', KEYS[3], '-inf', '(' .. since) or redis.call('zcard', KEYS[3])
+if older == 0 and total + size <= limit then
+    redis.call('hset', KEYS[2], ARGV[1], ARGV[2])
+    redis.call('zadd', KEYS[1], ARGV[5], ARGV[1])
+    redis.call('zrem', KEYS[3], ARGV[1])
+    redis.call('hdel', KEYS[4], ARGV[1])
+    return 1
+end
+if size > empty then
+    redis.call('zrem', KEYS[3], ARGV[1])
+    redis.call('hdel', KEYS[4], ARGV[1])
+    return -1
+end
+if not since then redis.call('zadd', KEYS[3], ARGV[4], ARGV[1]) end
+redis.call('hset', KEYS[4], ARGV[1], ARGV[4])
+return 0
+"""
+
+### bytes of files of reserved job on disk (only for existing reservation)
+lua_land_disk = """
+if redis.call('hexists', KEYS[1], ARGV[1]) == 0 then return 0 end
+redis.call('hset', KEYS[2], ARGV[1], ARGV[2])
+return 1
+"""
+
+### releasing of part of reservation and of bytes on disk (or of all of it if size is empty)
+lua_release_disk = """
+if redis.call('hexists', KEYS[2], ARGV[1]) == 0 then return 0 end
+if ARGV[2] ~= '' then
+    if redis.call('hexists', KEYS[3], ARGV[1]) == 1 and redis.call('hincrby', KEYS[3], ARGV[1], -tonumber(ARGV[2])) <= 0 then
+        redis.call('hdel', KEYS[3], ARGV[1])
+    end
+    local left = redis.call('hincrby', KEYS[2], ARGV[1], -tonumber(ARGV[2]))
+    if left > 0 then return left end
+end
+redis.call('hdel', KEYS[2], ARGV[1])
+redis.call('hdel', KEYS[3], ARGV[1])
+redis.call('zrem', KEYS[1], ARGV[1])
+return 0
+"""
+
+
+class DiskBudget:
+    """
+    budget of scratch space of data volume shared by workers: every job reserves its estimated footprint
+    before downloading and the reservation is released as files are deleted, the job reports bytes of its files
+    on disk after every stage (land), the job is admitted if it fits into free space of volume (without headroom)
+    plus bytes which reserved jobs have on disk already minus reservations (and into capacity if it is given),
+    so written files are not counted twice, jobs which do not fit wait in FIFO order - so large jobs are not starved,
+    reservations are kept with ttl (prolonged by heartbeat) - so crashed jobs do not hold the space,
+    waiters which are not seen for stale seconds leave the queue
+    """
+
+    def __init__(self,
+                redisdb: object = None,
+                capacity: int = 0,
+                path: str = '',
+                headroom: int = 1024**3,
+                ttl: int = 3600,
+                stale: int = 180,
+                logger: object = None):
+
+        self.redisdb = redisdb
+        self.capacity = capacity
+        self.path = path or os.getcwd()
+        self.headroom = headroom
+        self.ttl = ttl
+        self.stale = stale
+        self.logger = logger
+        self.pref_msg = ''
+        self.prefix = 'disk'
+        self.conn = None
+
+
+    def log(self, tag: str = 'disk-budget', log_level: str = 'info', message: str = '', data: dict = {}):
+
+        log(self.logger, tag, log_level, message, data)
+
+
+    def connect(self):
+
+        if self.conn is None:
+            self.conn = self.redisdb.client()
+
+
+    def keys(self) -> list:
+
+        return [f"{self.prefix}_reserved", f"{self.prefix}_bytes", f"{self.prefix}_waiting", f"{self.prefix}_seen",\
+                f"{self.prefix}_landed"]
+
+
+    def free(self) -> int:
+        """
+        free space of volume without headroom
+        """
+
+        return shutil.disk_usage(self.path).free - self.headroom
+
+
+    def limit(self) -> int:
+        """
+        free space of volume without headroom (not more than capacity if it is given)
+        """
+
+        free = self.free()
+
+        return max(0, min(free, self.capacity) if self.capacity else free)
+
+
+    def reserve(self, token: str = '', size: int = 0) -> int:
+        """
+        reservation of size bytes for token (prolongation if it is reserved already),
+        as result - 1 if it is reserved, 0 if it waits in the queue, -1 if it does not fit into the empty budget
+        """
+
+        self.connect()
+        try:
+            now = time()
+            return int(self.conn.eval(lua_reserve_disk, 5, *self.keys(), token, int(size), self.free(), now, now + self.ttl,\
+                                      self.stale, self.capacity))
+        except Exception as error:
+            self.log('reserving disk', 'error', f"{self.pref_msg}Problem with reserving {bytes2human(size)} for {token}: {error}")
+
+        ### the budget must not stop jobs if Redis is not available
+        return 1
+
+
+    def renew_lease(self, key: str = '', token: str = '', ttl: int = None) -> bool:
+        """
+        prolongation of reservation (for LeaseHeartbeat)
+        """
+
+        self.connect()
+        try:
+            self.conn.zadd(self.keys()[0], {token:time() + (ttl or self.ttl)}, xx = True)
+            return True
+        except Exception as error:
+            self.log('reserving disk', 'error', f"{self.pref_msg}Problem with renewing reservation {token}: {error}")
+
+        return False
+
+
+    def land(self, token: str = '', size: int = 0) -> bool:
+        """
+        bytes of files of reserved job on disk now (they are taken from free space of volume already)
+        """
+
+        self.connect()
+        try:
+            return bool(self.conn.eval(lua_land_disk, 2, self.keys()[1], self.keys()[4], token, int(size)))
+        except Exception as error:
+            self.log('reserving disk', 'error', f"{self.pref_msg}Problem with bytes on disk of {token}: {error}")
+
+        return False
+
+
+    def release(self, token: str = '', size: int = None) -> int:
+        """
+        releasing of size bytes of reservation (all of it by default), as result - bytes left
+        """
+
+        self.connect()
+        try:
+            return self.conn.eval(lua_release_disk, 3, *self.keys()[:2], self.keys()[4], token, '' if size is None else int(size))
+        except Exception as error:
+            self.log('releasing disk', 'error', f"{self.pref_msg}Problem with releasing reservation {token}: {error}")
+
+        return 0
+
+
+    def usage(self) -> dict:
+        """
+        free space for reservations, reserved bytes, bytes of reserved jobs on disk and waiting jobs for monitoring
+        """
+
+        self.connect()
+        reserved = sum([int(x) for x in self.conn.hvals(self.keys()[1])])
+        landed = sum([int(x) for x in self.conn.hvals(self.keys()[4])])
+
+        return {'limit':self.limit(), 'reserved':reserved, 'landed':landed, 'jobs':self.conn.hlen(self.keys()[1]),
+                'waiting':self.conn.zcard(self.keys()[2])}
@@ -0,0 +1,156 @@
+from .utils import *
+import shutil
+import sqlite3
+from contextlib import closing
+
+
+#####################################################################################################
+#### Local cache of audio files
+#####################################################################################################
+
+class AudioCache:
+    """
+    local cache of audio files keyed by (video id, codec, quality),
+    files are kept in the cache folder as hard links and the index is kept in sqlite file,
+    so several workers on the same data volume share the one cache,
+    the least recently used files are evicted when the size of cache is over the budget
+    """
+
+    def __init__(self,
+                logger: object = None,
+                path_cache: str = '',
+                max_bytes: int = 5*1024**3,
+                timeout: int = 30):
+
+        self.path_cache = path_cache
+        self.path_index = os.path.join(path_cache, 'index.sqlite')
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.pref_msg = ''
+        self.logger = logger
+        #-------------------------------------------------------------------------------------------------
+        if not os.path.exists(self.path_cache):
+            os.makedirs(self.path_cache)
+        with closing(self.connect()) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS entries "
+                         "(key TEXT PRIMARY KEY, fpath TEXT, fname TEXT, size INTEGER, atime REAL)")
+
+
+    def log(self, tag: str = 'audio-cache', log_level: str = 'info', message: str = '', data: dict = {}):
+
+        log(self.logger, tag, log_level, message, data)
+
+
+    def connect(self) -> object:
+        """
+        connection to the index, one per call - so it is safe for threads and processes
+        """
+
+        conn = sqlite3.connect(self.path_index, timeout = self.timeout, isolation_level = None)
+        conn.execute('PRAGMA journal_mode=WAL')
+
+        return conn
+
+
+    @staticmethod
+    def make_key(video_id: str = '', codec: str = '', quality: str = '') -> str:
+
+        return f"{video_id}_{codec}_{quality}"
+
+
+    def get(self, key: str = '', path_to_save: str = '') -> str:
+        """
+        linking of cached file into path_to_save with the original name,
+        as result - path to the file or None
+        """
+
+        try:
+            with closing(self.connect()) as conn:
+                row = conn.execute("SELECT fpath, fname FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is None: return None
+                #-----------------------------------------------------------------------------------------
+                if not os.path.isfile(row[0]):
+                    conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                    return None
+                conn.execute("UPDATE entries SET atime = ? WHERE key = ?", (time(), key))
+            #---------------------------------------------------------------------------------------------
+            os.makedirs(path_to_save, exist_ok = True)
+            fpath = os.path.join(path_to_save, row[1])
+            try:
+                os.link(row[0], fpath)
+            except OSError as error:
+                if os.path.exists(fpath): raise error
+                shutil.copyfile(row[0], fpath)
+            self.log('reading cache', 'info', f"{self.pref_msg}Cache hit for {key}: {fpath}")
+            return fpath
+        except Exception as error:
+            self.log('reading cache', 'error', f"{self.pref_msg}Problem with reading cache for {key}: {error}")
+
+        return None
+
+
+    def has(self, key: str = '') -> bool:
+        """
+        checking of key in the index (without linking of file)
+        """
+
+        try:
+            with closing(self.connect()) as conn:
+                return conn.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is not None
+        except Exception as error:
+            self.log('reading cache', 'error', f"{self.pref_msg}Problem with reading cache for {key}: {error}")
+
+        return False
+
+
+    def put(self, key: str = '', fpath: str = '') -> bool:
+        """
+        saving of downloaded file into cache (by hard link, without copying)
+        """
+
+        try:
+            size = os.path.getsize(fpath)
+            if size > self.max_bytes: return False
+            fpath_cache = os.path.join(self.path_cache, key + os.path.splitext(fpath)[1])
+            #---------------------------------------------------------------------------------------------
+            if os.path.exists(fpath_cache): os.remove(fpath_cache)
+            try:
+                os.link(fpath, fpath_cache)
+            except OSError:
+                shutil.copyfile(fpath, fpath_cache)
+            #---------------------------------------------------------------------------------------------
+            with closing(self.connect()) as conn:
+                conn.execute("INSERT OR REPLACE INTO entries (key, fpath, fname, size, atime) VALUES (?, ?, ?, ?, ?)",\
+                             (key, fpath_cache, os.path.basename(fpath), size, time()))
+            self.evict()
+            return True
+        except Exception as error:
+            self.log('writing cache', 'error', f"{self.pref_msg}Problem with writing cache for {key}: {error}")
+
+        return False
+
+
+    def evict(self):
+        """
+        removing of the least recently used files while cache is over the budget
+        """
+
+        removed = []
+        with closing(self.connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+                for key, fpath, size in conn.execute("SELECT key, fpath, size FROM entries ORDER BY atime").fetchall():
+                    if total <= self.max_bytes: break
+                    conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                    removed.append(fpath)
+                    total -= size
+                conn.execute('COMMIT')
+            except Exception as error:
+                conn.execute('ROLLBACK')
+                raise error
+        #-------------------------------------------------------------------------------------------------
+        for fpath in removed:
+            if os.path.exists(fpath): os.remove(fpath)
+        if removed:
+            self.log('evicting cache', 'info', f"{self.pref_msg}Removed {len(removed)} files from cache, budget {bytes2human(self.max_bytes)}")
@@ -0,0 +1,139 @@
+from .utils import *
+from .youtube_download import video_id
+
+
+#####################################################################################################
+#### Cache of metadata of videos
+#####################################################################################################
+
+class MetaCache:
+    """
+    metadata of videos (result of extraction by youtube_dl without processing) in Redis by id of video with ttl,
+    it is prefetched by web tier when job is accepted, so worker starts downloading without extraction
+    and the next stages plan by it without network calls,
+    links of formats are signed for a few hours - so ttl is shorter than their life
+    """
+
+    ### heavy parts of metadata which are not used by processing
+    skip_keys = ['automatic_captions', 'subtitles', 'thumbnails', 'chapters']
+
+    def __init__(self,
+                redisdb: object = None,
+                ttl: int = 3*3600,
+                logger: object = None):
+
+        self.redisdb = redisdb
+        self.ttl = ttl
+        self.logger = logger
+        self.pref_msg = ''
+        self.conn = None
+
+
+    def log(self, tag: str = 'meta-cache', log_level: str = 'info', message: str = '', data: dict = {}):
+
+        log(self.logger, tag, log_level, message, data)
+
+
+    def connect(self):
+
+        if self.conn is None:
+            self.conn = self.redisdb.client()
+
+
+    @staticmethod
+    def key(vid: str = '') -> str:
+
+        return f"meta_{vid}"
+
+
+    def get(self, url: str = '') -> dict:
+        """
+        cached metadata of link or None
+        """
+
+        vid = video_id(url)
+        if vid is None: return None
+        try:
+            self.connect()
+            value = self.conn.get(self.key(vid))
+            return json.loads(value) if value else None
+        except Exception as error:
+            self.log('reading metadata', 'error', f"{self.pref_msg}Problem with reading metadata of {vid}: {error}")
+
+        return None
+
+
+    def put(self, url: str = '', information: dict = {}) -> bool:
+
+        vid = video_id(url)
+        if vid is None or not information: return False
+        try:
+            self.connect()
+            value = json.dumps({k:v for k,v in information.items() if k not in self.skip_keys}, cls = NpEncoder, default = str)
+            self.conn.setex(self.key(vid), self.ttl, value)
+            return True
+        except Exception as error:
+            self.log('writing metadata', 'error', f"{self.pref_msg}Problem with writing metadata of {vid}: {error}")
+
+        return False
+
+
+    def delete(self, url: str = ''):
+
+        vid = video_id(url)
+        if vid is None: return
+        try:
+            self.connect()
+            self.conn.delete(self.key(vid))
+        except Exception as error:
+            self.log('deleting metadata', 'error', f"{self.pref_msg}Problem with deleting metadata of {vid}: {error}")
+
+
+    def fetch(self, url: str = '') -> dict:
+        """
+        metadata of link from cache or by extraction (without downloading and processing of formats)
+        """
+
+        information = self.get(url)
+        if information is None and video_id(url):
+            try:
+                ydl = youtube_dl.YoutubeDL({'quiet':True, 'skip_download':True})
+                information = ydl.extract_info(url, download = False, process = False)
+                self.put(url, information)
+            except Exception as error:
+                self.log('extracting metadata', 'error', f"{self.pref_msg}Problem with extracting metadata of {url}: {error}")
+
+        return information
+
+
+    @staticmethod
+    def estimate(information: dict = {}, bitrate: str = '320') -> int:
+        """
+        scratch footprint of video in bytes: the source stream (the smallest audio stream not lower
+        than bitrate or the best one) and the result (duration * bitrate), None if it is unknown
+        """
+
+        duration = information.get('duration')
+        if not duration: return None
+        #---------------------------------------------------------------------------------------------
+        size = lambda x: x.get('filesize') or x.get('filesize_approx') or duration * x.get('abr', 0) * 125
+        formats = [x for x in information.get('formats') or [] if x.get('vcodec') == 'none' and x.get('abr')]
+        enough = [x for x in formats if x['abr'] >= float(bitrate)]
+        source = min(enough, key = lambda x: x['abr']) if enough else max(formats, key = lambda x: x['abr'], default = {})
+
+        return int(size(source) + duration * float(bitrate) * 125)
+
+
+    @staticmethod
+    def summary(information: dict = {}) -> dict:
+        """
+        title, duration and audio formats with sizes
+        """
+
+        return {
+            'id':information.get('id'),
+            'title':information.get('title'),
+            'duration':information.get('duration'),
+            'formats':[{k:x.get(k) for k in ['format_id', 'ext', 'acodec', 'abr', 'filesize']}
+                       for x in information.get('formats') or [] if x.get('vcodec') == 'none'],
+        }
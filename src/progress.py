@@ -0,0 +1,195 @@
+from .utils import *
+
+
+#####################################################################################################
+#### Progress of jobs by links
+#####################################################################################################
+
+class JobProgress:
+    """
+    progress of links of job in own Redis hash of job (progress_job_<job>: url -> state) with ttl,
+    jobs of user are kept in the small index (progress_<user>_jobs: job -> deadline) - active jobs for ttl
+    since the last write, finished jobs for keep seconds, not more than max_jobs of them,
+    every write increments the version of user and publishes it into the channel of user,
+    writes of the same link are throttled by interval (except changes of stage)
+    """
+
+    def __init__(self,
+                redisdb: object = None,
+                user: str = '',
+                job: str = '',
+                interval: float = 1,
+                ttl: int = 86400,
+                keep: int = 3600,
+                max_jobs: int = 10,
+                logger: object = None):
+
+        self.redisdb = redisdb
+        self.user = user
+        self.job = job
+        self.interval = interval
+        self.ttl = ttl
+        self.keep = keep
+        self.max_jobs = max_jobs
+        self.logger = logger
+        self.pref_msg = ''
+        self.states = {}
+        self.written = {}
+        self.lock = threading.Lock()
+        self.conn = None
+
+
+    def log(self, tag: str = 'job-progress', log_level: str = 'info', message: str = '', data: dict = {}):
+
+        log(self.logger, tag, log_level, message, data)
+
+
+    @staticmethod
+    def key(user: str = '') -> str:
+
+        return f"progress_{user}"
+
+
+    @staticmethod
+    def job_key(job: str = '') -> str:
+
+        return f"progress_job_{job}"
+
+
+    def connect(self):
+
+        if self.conn is None:
+            self.conn = self.redisdb.client()
+
+
+    def update(self, url: str = '', stage: str = '', **fields):
+        """
+        state of link: stage (queued, waiting, extract, download, postprocess, rename, upload, retry, done, error)
+        and fields of progress (bytes, total, speed, eta)
+        """
+
+        with self.lock:
+            state = self.states.setdefault(url, {'job':self.job, 'url':url})
+            changed = state.get('stage') != stage
+            state.update(fields, stage = stage, updated = round(time(), 3))
+            if not changed and time() - self.written.get(url, 0) < self.interval: return
+            self.written[url] = time()
+            state = dict(state)
+        #---------------------------------------------------------------------------------------------------------
+        try:
+            self.connect()
+            pipe = self.conn.pipeline(transaction = False)
+            pipe.hset(self.job_key(self.job), url, json.dumps(state, cls = NpEncoder))
+            pipe.expire(self.job_key(self.job), self.ttl)
+            self.index(pipe, time() + self.ttl)
+            self.publish(pipe)
+        except Exception as error:
+            self.log('progress of job', 'error', f"{self.pref_msg}Problem with writing progress of {url}: {error}")
+
+
+    def finish(self):
+        """
+        the job is finished: its progress is kept for keep seconds
+        """
+
+        try:
+            self.connect()
+            pipe = self.conn.pipeline(transaction = False)
+            pipe.expire(self.job_key(self.job), self.keep)
+            self.index(pipe, time() + self.keep)
+            self.publish(pipe)
+        except Exception as error:
+            self.log('progress of job', 'error', f"{self.pref_msg}Problem with finishing progress of {self.job}: {error}")
+
+
+    def index(self, pipe: object = None, deadline: float = 0):
+        """
+        job in the index of user (expired jobs and the oldest ones over max_jobs leave the index)
+        """
+
+        jobs_key = f"{self.key(self.user)}_jobs"
+        pipe.zadd(jobs_key, {self.job:deadline})
+        pipe.zremrangebyscore(jobs_key, '-inf', time())
+        pipe.zremrangebyrank(jobs_key, 0, -self.max_jobs - 1)
+        pipe.expire(jobs_key, self.ttl)
+
+
+    def publish(self, pipe: object = None):
+        """
+        new version of progress of user for waiting readers
+        """
+
+        pipe.incr(f"{self.key(self.user)}_v")
+        pipe.expire(f"{self.key(self.user)}_v", self.ttl)
+        version = pipe.execute()[-2]
+        self.conn.publish(self.key(self.user), version)
+
+
+    def download_hook(self, url: str = '', d: dict = {}):
+        """
+        progress from hook of youtube_dl
+        """
+
+        if d.get('status') == 'downloading':
+            self.update(url, 'download',
+                        bytes = d.get('downloaded_bytes'),
+                        total = d.get('total_bytes') or d.get('total_bytes_estimate'),
+                        speed = d.get('speed'),
+                        eta = d.get('eta'))
+        elif d.get('status') == 'finished':
+            self.update(url, 'postprocess', bytes = d.get('total_bytes'), total = d.get('total_bytes'), speed = None, eta = None)
+
+
+    @classmethod
+    def read(cls, conn: object = None, user: str = '') -> dict:
+        """
+        version and states of links of jobs of user (from the index of user)
+        """
+
+        pipe = conn.pipeline(transaction = False)
+        pipe.get(f"{cls.key(user)}_v")
+        pipe.zrangebyscore(f"{cls.key(user)}_jobs", time(), '+inf')
+        version, jobs = pipe.execute()
+        #---------------------------------------------------------------------------------------------------------
+        pipe = conn.pipeline(transaction = False)
+        for job in jobs:
+            pipe.hvals(cls.job_key(job))
+        states = [x for values in pipe.execute() for x in values] if jobs else []
+
+        return {
+            'version':int(version or 0),
+            'links':sorted([json.loads(x) for x in states], key = lambda x: x.get('updated', 0)),
+        }
+
+
+    @classmethod
+    def read_job(cls, conn: object = None, job: str = '') -> list:
+        """
+        states of links of job
+        """
+
+        return sorted([json.loads(x) for x in conn.hvals(cls.job_key(job))], key = lambda x: x.get('updated', 0))
+
+
+    @classmethod
+    def wait(cls, conn: object = None, user: str = '', since: int = 0, timeout: float = 20) -> dict:
+        """
+        long polling: states of links as soon as version is newer than since (or after timeout)
+        """
+
+        result = cls.read(conn, user)
+        if result['version'] > since or timeout <= 0: return result
+        #---------------------------------------------------------------------------------------------------------
+        pubsub = conn.pubsub(ignore_subscribe_messages = True)
+        try:
+            pubsub.subscribe(cls.key(user))
+            ### the version could change between reading and subscribing
+            result = cls.read(conn, user)
+            finish = time() + timeout
+            while result['version'] <= since and time() < finish:
+                if pubsub.get_message(timeout = min(1, finish - time())):
+                    result = cls.read(conn, user)
+        finally:
+            pubsub.close()
+
+        return result
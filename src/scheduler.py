@@ -0,0 +1,326 @@
+from .utils import *
+
+
+#####################################################################################################
+#### Fair scheduling of jobs between users
+#####################################################################################################
+
+### atomic adding of job into the queue of user (with limit of pending jobs) and into the ring of users
+lua_enqueue_job = """
+if redis.call('llen', KEYS[1]) >= tonumber(ARGV[3]) then return 0 end
+redis.call('rpush', KEYS[1], ARGV[2])
+if redis.call('sadd', KEYS[2], ARGV[1]) == 1 then redis.call('rpush', KEYS[3], ARGV[1]) end
+redis.call('set', KEYS[4], 1)
+return 1
+"""
+
+
+class FairScheduler:
+    """
+    scheduler of jobs over per-user Redis lists by deficit round-robin:
+    every visit of user in the ring adds quantum * weight to the deficit of user,
+    and jobs are sent to Celery while the cost of job (expected count of links) fits into the deficit,
+    the count of running jobs is limited by user (user_limit) and in total (capacity),
+    the slot of job is taken by dispatching for ttl seconds and it is kept by tasks of job:
+    running tasks renew it (renew_lease by LeaseHeartbeat), sent tasks (in queues and waiting for retry)
+    are registered until they are started (track/untrack, not longer than queue_ttl),
+    the callback of job releases the slot, slots of jobs which are finished without callback (failed chords)
+    and of lost jobs (expired slot without queued tasks - after restart of workers) are reaped by dispatcher
+    """
+
+    def __init__(self,
+                redisdb: object = None,
+                capacity: int = 2,
+                user_limit: int = 1,
+                max_pending: int = 20,
+                quantum: int = 9,
+                ttl: int = 120,
+                queue_ttl: int = 12*3600,
+                logger: object = None):
+
+        self.redisdb = redisdb
+        self.capacity = capacity
+        self.user_limit = user_limit
+        self.max_pending = max_pending
+        self.quantum = quantum
+        self.ttl = ttl
+        self.queue_ttl = queue_ttl
+        self.logger = logger
+        self.pref_msg = ''
+        self.prefix = 'sched'
+        self.conn = None
+
+
+    def log(self, tag: str = 'scheduler', log_level: str = 'info', message: str = '', data: dict = {}):
+
+        log(self.logger, tag, log_level, message, data)
+
+
+    def connect(self):
+
+        if self.conn is None:
+            self.conn = self.redisdb.client()
+
+
+    def key(self, name: str = '', user: str = '') -> str:
+
+        return f"{self.prefix}_{name}_{user}" if user else f"{self.prefix}_{name}"
+
+
+    def enqueue(self, user: str = '', params: dict = {}) -> bool:
+        """
+        adding of job into the queue of user by one round trip,
+        as result - False if the queue of user is full
+        """
+
+        self.connect()
+        try:
+            return bool(self.conn.eval(lua_enqueue_job, 4,
+                                       self.key('jobs', user), self.key('users_set'), self.key('users'), self.key('dirty'),
+                                       user, json.dumps(params, cls = NpEncoder), self.max_pending))
+        except Exception as error:
+            self.log('queue of user', 'error', f"{self.pref_msg}Problem with adding job of user: {error}")
+
+        return False
+
+
+    def pending(self, user: str = '') -> int:
+
+        self.connect()
+
+        return self.conn.llen(self.key('jobs', user))
+
+
+    def set_weight(self, user: str = '', weight: float = 1):
+
+        self.connect()
+        self.conn.hset(self.key('weights'), user, weight)
+
+
+    def take_slot(self, user: str = '', token: str = '') -> bool:
+        """
+        taking of slot of dispatched job
+        """
+
+        self.connect()
+        expire = time() + self.ttl
+        try:
+            pipe = self.conn.pipeline(transaction = False)
+            pipe.zadd(self.key('running', user), {token:expire})
+            pipe.zadd(self.key('running'), {f"{user}|{token}":expire})
+            pipe.execute()
+            return True
+        except Exception as error:
+            self.log('slot of job', 'error', f"{self.pref_msg}Problem with taking slot {token}: {error}")
+
+        return False
+
+
+    def renew_lease(self, user: str = '', token: str = '', ttl: int = None) -> bool:
+        """
+        prolongation of slot of job (by running task), the released slot is not taken again,
+        as result - False if the slot is not held
+        """
+
+        self.connect()
+        expire = time() + (ttl or self.ttl)
+        try:
+            pipe = self.conn.pipeline(transaction = False)
+            pipe.zadd(self.key('running', user), {token:expire}, xx = True, ch = True)
+            pipe.zadd(self.key('running'), {f"{user}|{token}":expire}, xx = True, ch = True)
+            return pipe.execute()[1] > 0
+        except Exception as error:
+            self.log('slot of job', 'error', f"{self.pref_msg}Problem with renewing slot {token}: {error}")
+
+        return False
+
+
+    def track(self, token: str = '', task_id: str = '') -> bool:
+        """
+        registering of task of job which is sent to queue (or for retry), it keeps the job alive until it is started
+        """
+
+        self.connect()
+        try:
+            pipe = self.conn.pipeline(transaction = False)
+            pipe.zadd(self.key('queued', token), {task_id:time()})
+            pipe.expire(self.key('queued', token), self.queue_ttl)
+            pipe.execute()
+            return True
+        except Exception as error:
+            self.log('slot of job', 'error', f"{self.pref_msg}Problem with registering task {task_id} of {token}: {error}")
+
+        return False
+
+
+    def untrack(self, token: str = '', task_id: str = ''):
+        """
+        the task of job is started
+        """
+
+        self.connect()
+        try:
+            self.conn.zrem(self.key('queued', token), task_id)
+        except Exception as error:
+            self.log('slot of job', 'error', f"{self.pref_msg}Problem with unregistering task {task_id} of {token}: {error}")
+
+
+    def queued(self, token: str = '') -> int:
+        """
+        count of sent tasks of job which are not started (sent not earlier than queue_ttl ago)
+        """
+
+        self.connect()
+
+        return self.conn.zcount(self.key('queued', token), time() - self.queue_ttl, '+inf')
+
+
+    def release_lease(self, user: str = '', token: str = '') -> bool:
+        """
+        releasing of slot of finished job
+        """
+
+        self.connect()
+        try:
+            pipe = self.conn.pipeline(transaction = False)
+            pipe.zrem(self.key('running', user), token)
+            pipe.zrem(self.key('running'), f"{user}|{token}")
+            pipe.delete(self.key('queued', token))
+            pipe.set(self.key('dirty'), 1)
+            pipe.execute()
+            return True
+        except Exception as error:
+            self.log('slot of job', 'error', f"{self.pref_msg}Problem with releasing slot {token}: {error}")
+
+        return False
+
+
+    def reap(self, finished: object = None) -> int:
+        """
+        releasing of slots of jobs which are finished by finished(job) (their callbacks are not called)
+        and of lost jobs (the slot is expired and no task of job is queued),
+        expired slots of jobs with queued tasks are prolonged
+        """
+
+        count, now = 0, time()
+        for member, expire in self.conn.zrange(self.key('running'), 0, -1, withscores = True):
+            user, token = member.split('|', 1)
+            if (finished and finished(token)) or (expire < now and not self.queued(token)):
+                count += self.release_lease(user, token)
+            elif expire < now:
+                self.renew_lease(user, token)
+        if count:
+            self.log('dispatching jobs', 'warn', f"{self.pref_msg}Released {count} slots of finished or lost jobs")
+
+        return count
+
+
+    def dispatch(self, send: object = None, finished: object = None) -> int:
+        """
+        sending of jobs to Celery by send(params) in fair order,
+        only one dispatcher works at the same time (by lock), others leave the flag 'dirty'
+        and the holder of lock repeats the round,
+        slots of finished and lost jobs are reaped before the round (finished - optional check of job by id)
+        """
+
+        self.connect()
+        count, token = 0, make_guid(os.getpid(), threading.get_ident(), time())
+        try:
+            while self.conn.set(self.key('lock'), token, nx = True, ex = 60):
+                try:
+                    self.conn.delete(self.key('dirty'))
+                    self.reap(finished)
+                    count += self.dispatch_round(send)
+                finally:
+                    self.conn.eval(lua_release_lease, 1, self.key('lock'), token)
+                if not self.conn.exists(self.key('dirty')): break
+        except Exception as error:
+            self.log('dispatching jobs', 'error', f"{self.pref_msg}Problem with dispatching of jobs: {error}")
+        #---------------------------------------------------------------------------------------------------------
+        if count:
+            self.log('dispatching jobs', 'info', f"{self.pref_msg}Sent {count} jobs")
+
+        return count
+
+
+    def dispatch_round(self, send: object = None) -> int:
+        """
+        one round of deficit round-robin over the ring of users with pending jobs
+        """
+
+        now = time()
+        self.conn.zremrangebyscore(self.key('running'), '-inf', now)
+        free = self.capacity - self.conn.zcard(self.key('running'))
+        sent, idle = 0, 0
+        #---------------------------------------------------------------------------------------------------------
+        while free > 0:
+            user = self.conn.lpop(self.key('users'))
+            if user is None: break
+            jobs_key, running_key = self.key('jobs', user), self.key('running', user)
+            head, deficit = '', 0
+            ### the user goes back into the ring (or leaves it with empty queue) even if sending is failed,
+            ### otherwise the user stays in users_set without the ring and the queue is never dispatched
+            try:
+                head = self.conn.lindex(jobs_key, 0)
+                self.conn.zremrangebyscore(running_key, '-inf', now)
+                running = self.conn.zcard(running_key)
+                deficit = float(self.conn.hget(self.key('deficit'), user) or 0)
+                #-------------------------------------------------------------------------------------------------
+                ### user with all slots taken does not collect the deficit
+                if head is not None and running < self.user_limit:
+                    idle = 0
+                    deficit += self.quantum * float(self.conn.hget(self.key('weights'), user) or 1)
+                    while head is not None and free > 0 and running < self.user_limit:
+                        params = json.loads(head)
+                        cost = max(1, params.get('cost') or len(params.get('links', [])))
+                        if cost > deficit: break
+                        #-----------------------------------------------------------------------------------------
+                        self.conn.lpop(jobs_key)
+                        self.take_slot(user, params['job'])
+                        try:
+                            send(params)
+                        except Exception as error:
+                            self.conn.lpush(jobs_key, head)
+                            self.release_lease(user, params['job'])
+                            raise error
+                        deficit -= cost
+                        running, free, sent = running + 1, free - 1, sent + 1
+                        head = self.conn.lindex(jobs_key, 0)
+                elif head is not None:
+                    idle += 1
+            finally:
+                #-------------------------------------------------------------------------------------------------
+                ### empty queue leaves the ring and loses the deficit
+                if head is None:
+                    self.conn.srem(self.key('users_set'), user)
+                    self.conn.hdel(self.key('deficit'), user)
+                else:
+                    self.conn.hset(self.key('deficit'), user, deficit)
+                    self.conn.rpush(self.key('users'), user)
+            if idle >= self.conn.llen(self.key('users')): break
+
+        return sent
+
+
+    def depths(self) -> dict:
+        """
+        depths of queues by users for monitoring (users are shown by hash of token)
+        """
+
+        self.connect()
+        now = time()
+        users = set(self.conn.smembers(self.key('users_set')))
+        users.update([x.split('|')[0] for x in self.conn.zrangebyscore(self.key('running'), now, '+inf')])
+        #---------------------------------------------------------------------------------------------------------
+        pipe = self.conn.pipeline(transaction = False)
+        for user in users:
+            pipe.llen(self.key('jobs', user))
+            pipe.zcount(self.key('running', user), now, '+inf')
+        values = pipe.execute()
+
+        return {
+            'capacity':self.capacity,
+            'user_limit':self.user_limit,
+            'running':self.conn.zcount(self.key('running'), now, '+inf'),
+            'users':{make_guid(user)[:8]:{'pending':values[2*i], 'running':values[2*i + 1]} for i, user in enumerate(users)},
+        }
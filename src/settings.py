@@ -5,7 +5,23 @@ from celery.schedules import crontab
 from datetime import datetime, timedelta
 
 
+## queues: service tasks, downloading (network-bound), transcoding (CPU-bound), uploading (network-bound)
 QUEUE = 'main'
+QUEUE_DOWNLOAD = 'download'
+QUEUE_TRANSCODE = 'transcode'
+QUEUE_UPLOAD = 'upload'
+## slot of running job in seconds: it is renewed by running tasks of job (every third of ttl),
+## the job without running and queued tasks (lost by restart of workers) frees the slot after SLOT_TTL
+SLOT_TTL = 120
+## the longest wait of task of job in queue or for retry, in seconds (older sent tasks do not keep the job alive)
+JOB_TTL = 12*3600
+## long polling of /status in seconds and lifetime of one SSE stream (SSE is opt-in by stream=1),
+## waiting requests hold threads of gunicorn (16) - not more than STATUS_WAITERS of them at once
+STATUS_WAIT = 10
+STATUS_STREAM_TTL = 300
+STATUS_WAITERS = 8
+## user of progress of jobs from API
+API_USER = 'api'
 
 ### main directories ###############################################################################
 main_dirs = {}
@@ -13,6 +29,7 @@ main_dirs = {}
 main_dirs['ROOT'] = os.getcwd()
 main_dirs['DATA'] = os.path.join(main_dirs['ROOT'], 'data')
 main_dirs['LOGS'] = os.path.join(main_dirs['ROOT'], 'log')
+main_dirs['CACHE'] = os.path.join(main_dirs['DATA'], 'cache')
 
 for k,v in main_dirs.items():
     if k == 'ROOT':continue
@@ -47,6 +64,11 @@ class Settings(BaseSettings):
     REDIS__DB: int = 3
     REDIS__DB_STATUS: int = 11
 
+    ### scheduler of jobs: running jobs in total and by user, pending jobs by user
+    SCHED__CAPACITY: int = 4
+    SCHED__USER_LIMIT: int = 2
+    SCHED__MAX_PENDING: int = 20
+
     ##token for API
     APIBOT_TOKEN: str = 'secret'
     API_PORT: int = 5009
@@ -72,7 +94,15 @@ CELERY_ACCEPT_CONTENT = ['json', 'msgpack', 'yaml']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TASK_ROUTES = {
-    'youtube_task':{'queue':QUEUE},
+    'youtube_fetch':{'queue':QUEUE_DOWNLOAD},
+    'youtube_transcode':{'queue':QUEUE_TRANSCODE},
+    'youtube_upload':{'queue':QUEUE_UPLOAD},
+    'youtube_expand':{'queue':QUEUE},
+    'youtube_job':{'queue':QUEUE},
+    'youtube_dispatch':{'queue':QUEUE},
+}
+CELERY_BEAT_SCHEDULE = {
+    'youtube_dispatch':{'task':'youtube_dispatch', 'schedule':30.0},
 }
 
 template_logs = '$date - [$type] : resource - $source, Data - [$kind]: $msg\n'
\ No newline at end of file
@@ -0,0 +1,159 @@
+from .utils import *
+import subprocess
+from math import ceil
+
+
+#####################################################################################################
+#### Transcoding of downloaded files
+#####################################################################################################
+
+### target codecs: extension of file, encoder of ffmpeg and codecs of sources which are copied as they are,
+### pipe - options of muxer for streaming into pipe (only for codecs with constant bitrate and without headers),
+### rate - sample rate of stream in pipe
+codec_formats = {
+    'mp3':{'ext':'mp3', 'encoder':'libmp3lame', 'sources':['mp3'], 'pipe':['-write_xing', '0', '-id3v2_version', '0', '-f', 'mp3'],
+           'rate':44100},
+    'aac':{'ext':'m4a', 'encoder':'aac', 'sources':['aac']},
+    'm4a':{'ext':'m4a', 'encoder':'aac', 'sources':['aac']},
+    'opus':{'ext':'opus', 'encoder':'libopus', 'sources':['opus']},
+    'vorbis':{'ext':'ogg', 'encoder':'libvorbis', 'sources':['vorbis']},
+}
+
+
+def probe_audio(fpath: str = '', timeout: int = 60) -> dict:
+    """
+    codec and bitrate (kbps) of the first audio stream of file by ffprobe
+    """
+
+    res = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'a:0',
+                          '-show_entries', 'stream=codec_name,bit_rate:format=bit_rate', '-of', 'json', fpath],
+                         stdout = subprocess.PIPE, stderr = subprocess.PIPE, timeout = timeout, check = True)
+    info = json.loads(res.stdout or b'{}')
+    stream = (info.get('streams') or [{}])[0]
+    bit_rate = stream.get('bit_rate') or info.get('format', {}).get('bit_rate')
+
+    return {'codec':stream.get('codec_name'), 'bitrate':int(bit_rate) / 1000 if bit_rate else None}
+
+
+def transcode_file(fpath: str = '', codec: str = 'mp3', bitrate: str = '320', tolerance: float = 0.1,\
+                   timeout: int = 3600) -> dict:
+    """
+    transcoding of downloaded file into codec and bitrate by one ffmpeg process,
+    the audio stream is copied (remuxed) without re-encoding if the source has the same codec
+    and its bitrate is not higher than requested (with tolerance),
+    the source file is removed, as result - path of file, mode (copy, encode) and seconds
+    """
+
+    start, fmt = time(), codec_formats[codec]
+    source = probe_audio(fpath)
+    copy = source['codec'] in fmt['sources'] and source['bitrate'] is not None and \
+           source['bitrate'] <= float(bitrate) * (1 + tolerance)
+    #---------------------------------------------------------------------------------------------
+    base, ext = os.path.splitext(fpath)
+    fpath_ = f"{base}.{fmt['ext']}"
+    if copy and ext == f".{fmt['ext']}":
+        return {'fpath':fpath, 'mode':'copy', 'source':source, 'seconds':round(time() - start, 3)}
+    ### the target has the same name as source - the result is written aside and replaces the source
+    fpath_tmp = f"{base}.tmp.{fmt['ext']}" if fpath_ == fpath else fpath_
+    #---------------------------------------------------------------------------------------------
+    subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-i', fpath, '-vn', '-map', '0:a:0', '-threads', '1'] +\
+                   (['-c:a', 'copy'] if copy else ['-c:a', fmt['encoder'], '-b:a', f"{bitrate}k"]) + [fpath_tmp],
+                   stdout = subprocess.PIPE, stderr = subprocess.PIPE, timeout = timeout, check = True)
+    if fpath_tmp != fpath_:
+        os.replace(fpath_tmp, fpath_)
+    else:
+        os.remove(fpath)
+
+    return {'fpath':fpath_, 'mode':'copy' if copy else 'encode', 'source':source, 'seconds':round(time() - start, 3)}
+
+
+class AudioStream:
+    """
+    transcoding of source (url of format or path) by ffmpeg into pipe without intermediate files:
+    the output is read by chunks of exact size, it is padded by silence to whole seconds (self.seconds),
+    so the size of stream is known by count of frames and it is not more than the size declared in advance (self.size),
+    close() checks the result of ffmpeg and raises exception if the output is not complete
+    """
+
+    def __init__(self,
+                source: str = '',
+                headers: dict = {},
+                codec: str = 'mp3',
+                bitrate: str = '320',
+                duration: float = 0,
+                slack_frames: int = 8,
+                timeout: int = 60):
+
+        fmt = codec_formats[codec]
+        if not fmt.get('pipe') or not duration:
+            raise ValueError(f"streaming of {codec} without duration is not supported")
+        ### the output is padded by silence and cut to whole seconds, so the count of frames of CBR encoder is known:
+        ### frame is 1152 samples and 144000 * bitrate / rate bytes on average, slack_frames cover delay of encoder
+        rate = fmt['rate']
+        self.seconds = ceil(duration)
+        frames = ceil(self.seconds * rate / 1152) + slack_frames
+        self.size = ceil(frames * 144000 * int(bitrate) / rate)
+        self.fname = None
+        self.timeout = timeout
+        self.bytes = 0
+        #---------------------------------------------------------------------------------------------
+        head = ''.join([f"{k}: {v}\r\n" for k,v in (headers or {}).items()])
+        remote = ['-reconnect', '1', '-reconnect_streamed', '1'] if source.startswith('http') else []
+        self.proc = subprocess.Popen(['ffmpeg', '-nostdin', '-loglevel', 'error'] + remote +\
+                                     (['-headers', head] if head else []) +\
+                                     ['-i', source, '-vn', '-map', '0:a:0', '-threads', '1', '-ar', str(rate),
+                                      '-af', 'apad', '-t', str(self.seconds),
+                                      '-c:a', fmt['encoder'], '-b:a', f"{bitrate}k"] + fmt['pipe'] + ['pipe:1'],
+                                     stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        ### stderr is drained aside - the full pipe of errors would block ffmpeg
+        self.errors = []
+        self.drain = threading.Thread(target = lambda: self.errors.extend(self.proc.stderr.readlines()[-5:]), daemon = True)
+        self.drain.start()
+
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        the next size bytes of output (less only at the end of stream)
+        """
+
+        if size < 0:
+            data = self.proc.stdout.read()
+        else:
+            parts, left = [], size
+            while left > 0:
+                part = self.proc.stdout.read(left)
+                if not part: break
+                parts.append(part)
+                left -= len(part)
+            data = b''.join(parts)
+        self.bytes += len(data)
+
+        return data
+
+
+    def close(self):
+        """
+        waiting of ffmpeg, the exception is raised if transcoding is failed
+        """
+
+        self.proc.stdout.close()
+        code = self.proc.wait(timeout = self.timeout)
+        self.drain.join(timeout = self.timeout)
+        if code != 0:
+            raise Exception(f"ffmpeg exited with {code}: {b''.join(self.errors).decode('utf-8', 'replace').strip()}")
+
+
+    def kill(self):
+
+        if self.proc.poll() is None: self.proc.kill()
+        self.proc.wait()
+
+
+    def __enter__(self):
+
+        return self
+
+
+    def __exit__(self, *args):
+
+        self.kill()
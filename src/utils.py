@@ -8,18 +8,31 @@ import redis
 import string
 import socket
 import random
+import hashlib
+import atexit
 import logging
+import logging.handlers
+import threading
+import requests
 import youtube_dl
+import numpy as np
 import pandas as pd
 from mega import Mega
+from mega.errors import RequestError
+from mega.crypto import a32_to_str, str_to_a32, base64_url_encode, encrypt_key, encrypt_attr, get_chunks
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
 from time import time, sleep
-from importlib import reload
+from queue import Queue
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from dateutil.parser import parse
 from psutil._common import bytes2human
 from datetime import datetime, timedelta, date, timezone
 from flask import (
                     Flask,
                     Response,
+                    stream_with_context,
                     render_template,
                     make_response,
                     request,
@@ -61,24 +74,72 @@ class NpEncoder(json.JSONEncoder):
 ### Logging
 ###################################################################################################
 
-log_levels = ["debug", "info", "warn", "error"]
+log_levels = {"debug":logging.DEBUG, "info":logging.INFO, "warn":logging.WARNING, "error":logging.ERROR}
+
+### loggers of process by log_path: configured once, the files are written by the listener thread of process,
+### so callers only put records into the queue, the new name of service for the same log_path
+### (weekly names of files) replaces the previous logger - its listener and file are closed
+loggers = {}
+loggers_lock = threading.Lock()
+
+
+def stop_loggers():
+    """
+    flushing of queues of loggers of process
+    """
+
+    with loggers_lock:
+        for item in loggers.values():
+            if item['pid'] == os.getpid(): close_logger(item)
+        loggers.clear()
+
+atexit.register(stop_loggers)
+
+
+def close_logger(item: dict = {}):
+    """
+    flushing of queue of logger and closing of its file
+    """
+
+    item['listener'].stop()
+    for handler in item['listener'].handlers: handler.close()
+    for handler in list(item['logger'].handlers):
+        if isinstance(handler, logging.handlers.QueueHandler): item['logger'].removeHandler(handler)
+
 
 def logger_init(service_name: str = '', log_path: str = os.getcwd(), log_level: str = 'info') -> object:
     """
-    initialization of logger
+    initialization of logger (once per process, the next calls return the same logger)
     """
 
-    reload(logging)
     service_name = service_name if service_name != '' else socket.gethostname()
-
-    logging.basicConfig(
-            filename = os.path.join(log_path, f'{service_name}.log'),
-            level = logging.INFO if log_level == 'info' \
-                    else logging.ERROR if log_level == 'error' \
-                    else logging.WARN if log_level == 'warn' \
-                    else logging.DEBUG,
-        )
-    return logging.getLogger(service_name)
+    item = loggers.get(log_path)
+    if item is not None and item['pid'] == os.getpid() and item['name'] == service_name:
+        return item['logger']
+    #-----------------------------------------------------------------------------------------------
+    with loggers_lock:
+        item = loggers.get(log_path)
+        if item is not None and item['pid'] == os.getpid() and item['name'] != service_name:
+            close_logger(item)
+            item = None
+        ### the listener thread of parent is not alive in forked process
+        if item is None or item['pid'] != os.getpid():
+            file_handler = logging.FileHandler(os.path.join(log_path, f'{service_name}.log'))
+            file_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+            queue = Queue()
+            listener = logging.handlers.QueueListener(queue, file_handler)
+            listener.start()
+            #---------------------------------------------------------------------------------------
+            logger = logging.getLogger(service_name)
+            for handler in list(logger.handlers):
+                if isinstance(handler, logging.handlers.QueueHandler): logger.removeHandler(handler)
+            logger.addHandler(logging.handlers.QueueHandler(queue))
+            logger.propagate = False
+            item = {'name':service_name, 'logger':logger, 'listener':listener, 'pid':os.getpid()}
+            loggers[log_path] = item
+        item['logger'].setLevel(log_levels.get(log_level, logging.DEBUG))
+
+    return item['logger']
 
 
 def log(logger: object = None, tag: str = 'action-service', log_level: str = 'info', message: str = '', data: dict = {}) -> None:
@@ -86,10 +147,12 @@ def log(logger: object = None, tag: str = 'action-service', log_level: str = 'in
     logging with custom format:
     tag - some tag of action
     message - message for logging
-    data - some key-value pairs for additional data of logging
+    data - some key-value pairs for additional data of logging,
+    the record is encoded only if the level is enabled for logger
     """
 
-    if log_levels.index(log_level) >= log_levels.index(log_level) and logger:
+    level = log_levels.get(log_level, logging.INFO)
+    if logger and logger.isEnabledFor(level):
         log_info = {
             "level": log_level,
             "time": datetime.now(timezone.utc).isoformat(),
@@ -97,19 +160,93 @@ def log(logger: object = None, tag: str = 'action-service', log_level: str = 'in
             "message": message,
         }
         log_info.update(data)
-            
-        if log_level == 'info': logger.info(json.dumps(log_info, cls=NpEncoder))
-        elif log_level == 'debug':logger.debug(json.dumps(log_info, cls=NpEncoder))
-        elif log_level == 'warn': logger.warn(json.dumps(log_info, cls=NpEncoder))
-        elif log_level == 'error':logger.error(json.dumps(log_info, cls=NpEncoder))
+        logger.log(level, json.dumps(log_info, cls=NpEncoder))
 
 ####################################################################################################
 #### connectors 
 #####################################################################################################
 
+class NodeIndex:
+    """
+    path-keyed index of nodes of cloud built by one fetch of files tree,
+    it is updated in place after making folders and uploading and is expired by ttl
+    """
+
+    def __init__(self, ttl: int = 300):
+
+        self.ttl = ttl
+        self.built = time()
+        self.root_id = None
+        self.nodes = {}         ## handle -> node
+        self.folders = {}       ## (parent handle, name) -> handle of folder
+        self.content = {}       ## parent handle -> handles of children
+        self.lock = threading.RLock()
+
+
+    def expired(self) -> bool:
+
+        return time() - self.built > self.ttl
+
+
+    def build(self, files: dict = {}):
+        """
+        building of index from the tree of files (result of get_files)
+        """
+
+        with self.lock:
+            for node in files.values():
+                self.add(node)
+            self.built = time()
+
+
+    def add(self, node: dict = {}):
+        """
+        adding of node (with decrypted attributes) into index
+        """
+
+        with self.lock:
+            if node['h'] not in self.nodes and node.get('p'):
+                self.content.setdefault(node['p'], []).append(node['h'])
+            self.nodes[node['h']] = node
+            #--------------------------------------------------------------------------------
+            if node.get('t') == 2:
+                self.root_id = node['h']
+            elif node.get('t') == 1 and isinstance(node.get('a'), dict):
+                self.folders[(node.get('p'), node['a'].get('n'))] = node['h']
+
+
+    def find(self, path: str = '', parent: str = None) -> str:
+        """
+        handle of folder by path from the root of cloud drive (or from parent) or None
+        """
+
+        with self.lock:
+            handle = parent or self.root_id
+            for name in [x for x in path.split('/') if x]:
+                handle = self.folders.get((handle, name))
+                if handle is None: break
+
+        return handle
+
+
+    def listdir(self, handle: str = '') -> list:
+        """
+        nodes in the folder
+        """
+
+        with self.lock:
+            return [self.nodes[x] for x in self.content.get(handle, [])]
+
+
+### authenticated sessions of cloud by user, they live as long as worker process
+mega_sessions = {}
+mega_sessions_lock = threading.Lock()
+
+
 class Cloudmega:
     """
-    connection for uploading files to mega
+    connection for uploading files to mega,
+    the session of login is shared by all instances in the process (see mega_sessions)
     """
 
     def __init__(self, 
@@ -118,7 +255,12 @@ class Cloudmega:
                 password: str = '', 
                 dir_name: str = '',
                 start_date_of_files: object = None, 
-                end_date_of_files: object = None):
+                end_date_of_files: object = None,
+                ledger: object = None,
+                checkpoints: object = None,
+                chunked_min_bytes: int = 10*1024**2,
+                stat_ttl: int = 600,
+                index_ttl: int = 300):
         
         self.user = username
         self.domain = 'mega'
@@ -132,9 +274,16 @@ class Cloudmega:
         self.mega = None
         self.pref_msg = ''
         self.conn = None
-        self.log_levels = ["debug", "info", "warn", "error"]
         self.logger = logger
         self.stat_info = None
+        self.ledger = ledger
+        self.checkpoints = checkpoints
+        self.chunked_min_bytes = chunked_min_bytes
+        self.checkpoint_ttl = 86400
+        self.stat_ttl = stat_ttl
+        self.index_ttl = index_ttl
+        self.session = None
+        self.on_chunk = None
 
     
     def log(self, tag: str = 'action-service', log_level: str = 'info', message: str = '', data: dict = {}):
@@ -145,42 +294,128 @@ class Cloudmega:
         data - some key-value pairs for additional data of logging
         """
 
-        if self.log_levels.index(log_level) >= self.log_levels.index(log_level) and self.logger:
-            log_info = {
-                "level": log_level,
-                "time": datetime.now(timezone.utc).isoformat(),
-                "tag": tag,
-                "message": message,
-            }
-            log_info.update(data)
-            
-            if log_level == 'info': self.logger.info(json.dumps(log_info, cls=NpEncoder))
-            elif log_level == 'debug':self.logger.debug(json.dumps(log_info, cls=NpEncoder))
-            elif log_level == 'warn': self.logger.warn(json.dumps(log_info, cls=NpEncoder))
-            elif log_level == 'error':self.logger.error(json.dumps(log_info, cls=NpEncoder))
+        log(self.logger, tag, log_level, message, data)
 
 
     def connect(self):
         """
-        Connect to a Postgres database.
+        Connect to cloud by the session of process or login for the new one
         """
         
         if self.conn is None:
-            self.mega = Mega()
-            ###Connection to domain
+            with mega_sessions_lock:
+                self.session = mega_sessions.get(self.user)
+                ### session is not inherited by forked processes and it is not valid for other password
+                if self.session is None or self.session['pid'] != os.getpid() or self.session['password'] != self.password:
+                    self.session = None
+                    self.mega = Mega()
+                    ###Connection to domain
+                    try:
+                        self.session = {
+                            'conn':self.mega.login(self.user, self.password),
+                            'password':self.password,
+                            'pid':os.getpid(),
+                            'stat_time':0,
+                            'free':0,
+                        }
+                        mega_sessions[self.user] = self.session
+                        self.log('connection to cloud', 'info', f"{self.pref_msg}connection to cloud {self.domain} established")
+                    except Exception as error:
+                        self.log('connection to cloud', 'error', f"{self.pref_msg}Connection to cloud {self.domain}: {error}")
+            #--------------------------------------------------------------------------------------------------------------------------
+            if self.session:
+                self.conn = self.session['conn']
+                self.mega = self.conn
+
+
+    def reconnect(self):
+        """
+        new login instead of expired session
+        """
+
+        with mega_sessions_lock:
+            if mega_sessions.get(self.user) is self.session:
+                del mega_sessions[self.user]
+        self.conn, self.session = None, None
+        self.connect()
+
+
+    def request(self, func: object = None) -> object:
+        """
+        calling of func(conn) with re-authentification when the session is expired
+        """
+
+        try:
+            return func(self.conn)
+        except RequestError as error:
+            if error.code != -15: raise error
+            self.log('connection to cloud', 'warn', f"{self.pref_msg}Session of cloud {self.domain} expired, login again")
+            self.reconnect()
+            if self.conn is None: raise error
+            return func(self.conn)
+
+
+    def nodes(self, refresh: bool = False) -> object:
+        """
+        index of nodes of the session,
+        it is rebuilt by one fetch of files tree when it is expired (or refresh is asked)
+        """
+
+        index = self.session.get('index')
+        if refresh or index is None or index.expired():
+            index = NodeIndex(ttl = self.index_ttl)
+            index.build(self.request(lambda conn: conn.get_files()))
+            self.session['index'] = index
+
+        return index
+
+
+    def free_space(self) -> int:
+        """
+        free space of storage, the stats of storage are refreshed not often than stat_ttl
+        """
+
+        if self.session and time() - self.session['stat_time'] > self.stat_ttl:
             try:
-                self.conn = self.mega.login(self.user, self.password)
-                self.stat_info = self.conn.get_storage_space()
-                self.log('connection to cloud', 'info', "{}connection to cloud {} established: used {} from {}"\
+                self.stat_info = self.request(lambda conn: conn.get_storage_space())
+                self.session['free'] = self.stat_info['total'] - self.stat_info['used']
+                self.session['stat_time'] = time()
+                self.log('connection to cloud', 'info', "{}storage of cloud {}: used {} from {}"\
                                                         .format(self.pref_msg,\
                                                                 self.domain,\
                                                                 bytes2human(self.stat_info['used']),
                                                                 bytes2human(self.stat_info['total'])))
-                self.dir_size = self.stat_info['total'] - self.stat_info['used']
             except Exception as error:
-                self.log('connection to cloud', 'error', f"{self.pref_msg}Connection to cloud {self.domain}: {error}")
+                self.log('connection to cloud', 'error', f"{self.pref_msg}Problem with stats of cloud {self.domain}: {error}")
+        #------------------------------------------------------------------------------------------------------------------------------
+        self.dir_size = self.session['free'] if self.session else 0
+
+        return self.dir_size
                     
     
+    def find_folder(self, dir_name: str = '') -> str:
+        """
+        handle of folder by path or None, the index of nodes is rebuilt once if the folder is not found
+        (the folder could be made by other process after the index of this one was built)
+        """
+
+        return self.nodes().find(dir_name) or self.nodes(refresh = True).find(dir_name)
+
+
+    def lock_folders(self, key: str = '', token: str = '', timeout: int = 60) -> bool:
+        """
+        waiting for the lock of making folders (in Redis of ledger) not longer than timeout
+        """
+
+        if self.ledger is None: return False
+        finish = time() + timeout
+        while not self.ledger.acquire_lease(key, token, timeout):
+            if time() > finish: return False
+            sleep(0.5)
+
+        return True
+
+
     def json_extract(self, obj, key) -> list:
         """
         Recursively fetch values from nested JSON.
@@ -208,59 +443,76 @@ class Cloudmega:
         return values
     
 
-    def listdir(self) -> None:
+    def prepare_dates(self):
         """
-        List of files in directory of cloud
-        by filtering dates of creation/uploading
-        as result - table/dataframe with listing of path content.
+        dates of filtering of files from self.start_fdate and self.end_fdate
+        """
+
+        ###Proccessing start date ####################################################################################################
+        if not self.start_fdate: 
+            self.start_fdate = datetime(1970, 1, 1)
+        elif not isinstance(self.start_fdate, datetime):
+            try:
+                self.start_fdate = parse(str(self.start_fdate))
+            except:
+                self.start_fdate = datetime(1970, 1, 1)
+
+        ###Proccessing end date ######################################################################################################
+        if not self.end_fdate:
+            self.end_fdate = datetime.today()
+        elif not isinstance(self.end_fdate, datetime):
+            try:
+                self.end_fdate = parse(str(self.end_fdate))
+            except:
+                self.end_fdate = datetime.today()
+        #-------------------------------------------------------------------------------------------------------------------------------
+        if self.end_fdate < self.start_fdate: self.end_fdate = datetime.today()
+
+
+    def iter_listdir(self):
+        """
+        Generator of files in directory of cloud (dicts with fname, size, fdate)
+        filtered by dates of creation/uploading during one pass over the content of folder.
         Please, specify the directory in the cloud by definition self.dir_name
         """
 
         self.connect()
-        del self.dir_id, self.df_files
-        gc.collect()
         self.dir_id = None
-        self.df_files = pd.DataFrame(columns = ['fname','size', 'fdate'])
         #--------------------------------------------------------------------------------------------------------------------------------
         if self.conn:
             try:
-                self.dir_id, _ = self.conn.find(self.dir_name)
+                self.dir_id = self.find_folder(self.dir_name)
             except Exception as error:
                 self.log('connection to cloud', 'error', f"{self.pref_msg}Problem with connection to directory {self.dir_name}: {error}")
-            
-            ###Proccessing start date ####################################################################################################
-            if not self.start_fdate: 
-                self.start_fdate = datetime(1970, 1, 1)
-            elif not isinstance(self.start_fdate, datetime):
+            self.prepare_dates()
+        #--------------------------------------------------------------------------------------------------------------------------------
+        if self.dir_id:
+            for node in self.nodes().listdir(self.dir_id):
+                ### folders and nodes without attributes are skipped
                 try:
-                    self.start_fdate = parse(str(self.start_fdate))
+                    fdate = datetime.fromtimestamp(node['ts'])
+                    if self.start_fdate <= fdate <= self.end_fdate:
+                        yield {'fname':node['a']['n'], 'size':bytes2human(node['s']), 'fdate':fdate}
                 except:
-                    self.start_fdate = datetime(1970, 1, 1)
+                    continue
 
-            ###Proccessing end date ######################################################################################################
-            if not self.end_fdate:
-                self.end_fdate = datetime.today()
-            elif not isinstance(self.end_fdate, datetime):
-                try:
-                    self.end_fdate = parse(str(self.end_fdate))
-                except:
-                    self.end_fdate = datetime.today()
-            #-------------------------------------------------------------------------------------------------------------------------------
-            if self.end_fdate < self.start_fdate: self.end_fdate = datetime.today()
+
+    def listdir(self) -> None:
+        """
+        List of files in directory of cloud
+        by filtering dates of creation/uploading
+        as result - table/dataframe with listing of path content.
+        Please, specify the directory in the cloud by definition self.dir_name
+        """
+
+        del self.df_files
+        gc.collect()
+        columns = {'fname':[], 'size':[], 'fdate':[]}
         #--------------------------------------------------------------------------------------------------------------------------------
-        if self.dir_id:
-            self.stat_info = self.conn.get_files()
-            if isinstance(self.stat_info, dict):
-                for k,v in self.stat_info.items():
-                    try:
-                        if self.dir_id in self.json_extract(v, 'p'):
-                            if self.start_fdate <= datetime.fromtimestamp(self.json_extract(v, 'ts')[0]) <= self.end_fdate:
-                                self.df_files = self.df_files.append({'fname':self.json_extract(v, 'n')[0],\
-                                                                      'size':bytes2human(self.json_extract(v, 's')[0]),\
-                                                                      'fdate':datetime.fromtimestamp(self.json_extract(v, 'ts')[0])},\
-                                                                        ignore_index = True)
-                    except:
-                        None
+        for item in self.iter_listdir():
+            for k, v in item.items():
+                columns[k].append(v)
+        self.df_files = pd.DataFrame(columns, columns = ['fname','size', 'fdate'])
         #---------------------------------------------------------------------------------------------------------------------------------
         if not self.df_files.empty:
             self.df_files = self.df_files.sort_values(by = ['fdate']).reset_index(drop = True)
@@ -280,25 +532,39 @@ class Cloudmega:
         #------------------------------------------------------------------------------------------------------------------------------
         self.connect()
         del self.dir_id
-        self.dir_id, go_on = None, False
+        self.dir_id = None
         #--------------------------------------------------------------------------------------------------------------------------------
         if self.conn:
             try:
-                self.dir_id, _ = self.conn.find(dir_name)
+                self.dir_id = self.nodes().find(dir_name)
                 if self.dir_id:
                     self.log('directory in cloud', 'warn', f"{self.pref_msg}directory {dir_name} already exist {self.dir_id}")
                     return True
-                else:
+                #----------------------------------------------------------------------------------------------------------------------------
+                ### processes have own indexes of nodes and cloud allows folders with the same names,
+                ### so missing folders are made under the lock of path by fresh index (made by other process - found)
+                key, token = f"mkdir_{self.user}_{dir_name}", make_guid(os.getpid(), threading.get_ident(), time())
+                locked = self.lock_folders(key, token)
+                try:
+                    index = self.nodes(refresh = True)
+                    self.dir_id = index.find(dir_name)
+                    if self.dir_id:
+                        self.log('directory in cloud', 'warn', f"{self.pref_msg}directory {dir_name} already made {self.dir_id}")
+                        return True
                     self.log('directory in cloud', 'info', f"{self.pref_msg}directory {dir_name} not exist")
-                    go_on = True
-            except Exception as error:
-                self.log('directory in cloud', 'info', f"{self.pref_msg}directory {dir_name} not exist: {error}")
-                go_on = True
-            #----------------------------------------------------------------------------------------------------------------------------
-            try:
-                if go_on:
-                    self.stat_info = self.conn.create_folder(dir_name)
-                    self.dir_id = self.stat_info[dir_name.split('/')[-1]]
+                    #------------------------------------------------------------------------------------------------------------------------
+                    ### making of missing folders of path one by one from the root
+                    parent = index.root_id
+                    for name in [x for x in dir_name.split('/') if x]:
+                        handle = index.find(name, parent)
+                        if handle is None:
+                            self.stat_info = self.request(lambda conn: conn._mkdir(name = name, parent_node_id = parent))
+                            handle = self.stat_info['f'][0]['h']
+                            index.add(dict(self.stat_info['f'][0], a = {'n':name}))
+                        parent = handle
+                    self.dir_id = parent
+                finally:
+                    if locked: self.ledger.release_lease(key, token)
             except Exception as error:
                 self.log('making directory in cloud', 'error', f"{self.pref_msg}Problem during making directory {dir_name}: {error}")
                 return False
@@ -311,9 +577,226 @@ class Cloudmega:
             return False
         
 
+    def ledger_key(self) -> str:
+
+        return f"ledger_{self.user}_{self.dir_id}"
+
+
+    def check_ledger(self, fname: str = '', size: int = 0, sha: str = '') -> dict:
+        """
+        checking of file in ledger of uploaded files (folder, file name, size, content hash) -> node,
+        the ledger of folder is seeded from listing of cloud folder on the first use,
+        as result - node of existing file or None
+        """
+
+        if self.ledger is None: return None
+        #------------------------------------------------------------------------------------------------------------------------------
+        try:
+            entries = self.ledger.reading_fields(self.ledger_key(), ['__seeded__', f"{fname}|{size}"])
+            if entries.get('__seeded__') is None:
+                nodes = {f"{v['a']['n']}|{v['s']}":{'h':v['h'], 'sha':None} for v in self.nodes().listdir(self.dir_id) \
+                         if v.get('t') == 0 and isinstance(v.get('a'), dict)}
+                nodes['__seeded__'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                self.ledger.publish_fields(self.ledger_key(), nodes)
+                self.log('ledger of uploading', 'info', f"{self.pref_msg}Ledger of {self.dir_name} seeded by {len(nodes) - 1} files")
+                entry = nodes.get(f"{fname}|{size}")
+            else:
+                entry = entries[f"{fname}|{size}"]
+                entry = json.loads(entry) if entry else None
+            #--------------------------------------------------------------------------------------------------------------------------
+            ### files from listing of folder are known only by name and size,
+            ### the node has to be still in the cloud (by index of nodes, it is rebuilt once -
+            ### the file could be uploaded by other process after the index of this one was built)
+            if entry and entry['sha'] in [None, sha]:
+                if entry['h'] in self.nodes().nodes or entry['h'] in self.nodes(refresh = True).nodes:
+                    return {'f':[{'h':entry['h'], 'p':self.dir_id, 't':0, 's':size, 'n':fname}]}
+        except Exception as error:
+            self.log('ledger of uploading', 'error', f"{self.pref_msg}Problem with checking of ledger for {fname}: {error}")
+        
+        return None
+
+
+    def update_ledger(self, fname: str = '', size: int = 0, sha: str = '', node: dict = {}):
+        """
+        adding of uploaded file to ledger
+        """
+
+        if self.ledger is None: return
+        #------------------------------------------------------------------------------------------------------------------------------
+        try:
+            self.ledger.publish_fields(self.ledger_key(), {f"{fname}|{size}":{'h':self.json_extract(node, 'h')[0], 'sha':sha}})
+        except Exception as error:
+            self.log('ledger of uploading', 'error', f"{self.pref_msg}Problem with updating of ledger for {fname}: {error}")
+
+
+    def upload_chunked(self, fpath: str = '', sha: str = '') -> dict:
+        """
+        uploading file by chunks with checkpoints in Redis (upload url, key, confirmed chunks),
+        interrupted uploading of the same file is continued from the last confirmed chunk,
+        self.on_chunk(uploaded bytes, size) is called after every chunk if it is defined,
+        as result - the same response as from conn.upload
+        """
+
+        size = os.path.getsize(fpath)
+        key = f"upload_{self.user}_{self.dir_id}_{sha or file_hash(fpath)}"
+        state = self.checkpoints.reading_fields(key)
+        #------------------------------------------------------------------------------------------------------------------------------
+        if state.get('ul_url') and state.get('ul_key'):
+            ul_url, ul_key = state['ul_url'], json.loads(state['ul_key'])
+            self.log('file uploading', 'info', f"{self.pref_msg}Continue uploading of {os.path.basename(fpath)}: "\
+                                               f"{len([x for x in state if x.startswith('c')])} chunks are confirmed")
+        else:
+            ul_url = self.conn._api_request({'a':'u', 's':size})['p']
+            ul_key = [random.randint(0, 0xFFFFFFFF) for _ in range(6)]
+            state = {'ul_url':ul_url, 'ul_key':ul_key}
+            self.checkpoints.publish_fields(key, state, ttl = self.checkpoint_ttl)
+        #------------------------------------------------------------------------------------------------------------------------------
+        k_str = a32_to_str(ul_key[:4])
+        iv_str = a32_to_str([ul_key[4], ul_key[5], ul_key[4], ul_key[5]])
+        mac_encryptor = AES.new(k_str, AES.MODE_CBC, b'\0' * 16)
+        handle = state.get('handle')
+        with open(fpath, 'rb') as f:
+            for chunk_start, chunk_size in get_chunks(size):
+                chunk = f.read(chunk_size)
+                ### mac is calculated for every chunk (also for confirmed ones) - it is chained over the file
+                chunk_mac = AES.new(k_str, AES.MODE_CBC, iv_str).encrypt(chunk + b'\0' * (-len(chunk) % 16))[-16:]
+                mac_str = mac_encryptor.encrypt(chunk_mac)
+                if f"c{chunk_start}" in state: continue
+                #----------------------------------------------------------------------------------------------------------------------
+                counter = Counter.new(128, initial_value = (((ul_key[4] << 32) + ul_key[5]) << 64) + chunk_start // 16)
+                output = requests.post(f"{ul_url}/{chunk_start}",
+                                       data = AES.new(k_str, AES.MODE_CTR, counter = counter).encrypt(chunk),
+                                       timeout = getattr(self.conn, 'timeout', 160)).text
+                fields = {f"c{chunk_start}":1}
+                if output.lstrip('-').isdigit():
+                    ### upload url is not valid anymore - the next try starts from scratch
+                    self.checkpoints.delete_message(key)
+                    raise RequestError(int(output))
+                elif output:
+                    handle = fields['handle'] = output
+                self.checkpoints.publish_fields(key, fields, ttl = self.checkpoint_ttl)
+                if self.on_chunk: self.on_chunk(chunk_start + len(chunk), size)
+        #------------------------------------------------------------------------------------------------------------------------------
+        if handle is None:
+            raise Exception(f"uploading of {os.path.basename(fpath)} is not completed by cloud")
+        data = self.complete_upload(os.path.basename(fpath), handle, ul_key, mac_str)
+        self.checkpoints.delete_message(key)
+
+        return data
+
+
+    def complete_upload(self, fname: str = '', handle: str = '', ul_key: list = [], mac_str: bytes = b'') -> dict:
+        """
+        making of node of uploaded file in cloud directory by the key of upload and MAC of content,
+        as result - the same response as from conn.upload
+        """
+
+        file_mac = str_to_a32(mac_str)
+        meta_mac = (file_mac[0] ^ file_mac[1], file_mac[2] ^ file_mac[3])
+        key_node = [
+            ul_key[0] ^ ul_key[4], ul_key[1] ^ ul_key[5], ul_key[2] ^ meta_mac[0], ul_key[3] ^ meta_mac[1], 
+            ul_key[4], ul_key[5], meta_mac[0], meta_mac[1]
+        ]
+
+        return self.conn._api_request({
+            'a':'p',
+            't':self.dir_id,
+            'i':self.conn.request_id,
+            'n':[{
+                'h':handle,
+                't':0,
+                'a':base64_url_encode(encrypt_attr({'n':fname}, ul_key[:4])),
+                'k':base64_url_encode(a32_to_str(encrypt_key(key_node, self.conn.master_key))),
+            }]
+        })
+
+
+    def upload_stream(self, fname: str = '', stream: object = None, size: int = 0) -> dict:
+        """
+        uploading of stream (object with read and close) with declared size by chunks without local file:
+        every chunk is encrypted and sent as soon as it is read, MAC is chained over chunks on the fly,
+        so only one chunk is kept in memory, the tail of shorter stream is filled by zeros,
+        stream.close() is called before making of node (its exception cancels uploading),
+        the stream can not be continued after failure - there are no checkpoints,
+        as result - the same response as from conn.upload
+        """
+
+        ul_url = self.request(lambda conn: conn._api_request({'a':'u', 's':size}))['p']
+        ul_key = [random.randint(0, 0xFFFFFFFF) for _ in range(6)]
+        k_str = a32_to_str(ul_key[:4])
+        iv_str = a32_to_str([ul_key[4], ul_key[5], ul_key[4], ul_key[5]])
+        mac_encryptor = AES.new(k_str, AES.MODE_CBC, b'\0' * 16)
+        handle, done = None, 0
+        #------------------------------------------------------------------------------------------------------------------------------
+        for chunk_start, chunk_size in get_chunks(size):
+            chunk = stream.read(chunk_size)
+            done += len(chunk)
+            chunk += b'\0' * (chunk_size - len(chunk))
+            chunk_mac = AES.new(k_str, AES.MODE_CBC, iv_str).encrypt(chunk + b'\0' * (-len(chunk) % 16))[-16:]
+            mac_str = mac_encryptor.encrypt(chunk_mac)
+            counter = Counter.new(128, initial_value = (((ul_key[4] << 32) + ul_key[5]) << 64) + chunk_start // 16)
+            output = requests.post(f"{ul_url}/{chunk_start}",
+                                   data = AES.new(k_str, AES.MODE_CTR, counter = counter).encrypt(chunk),
+                                   timeout = getattr(self.conn, 'timeout', 160)).text
+            if output.lstrip('-').isdigit():
+                raise RequestError(int(output))
+            elif output:
+                handle = output
+            if self.on_chunk: self.on_chunk(chunk_start + chunk_size, size)
+        #------------------------------------------------------------------------------------------------------------------------------
+        if stream.read(1):
+            raise Exception(f"stream of {fname} is longer than declared size {bytes2human(size)}")
+        stream.close()
+        if handle is None:
+            raise Exception(f"uploading of {fname} is not completed by cloud")
+        self.log('file uploading', 'info', f"{self.pref_msg}Stream of {fname}: {bytes2human(done)} of content, "\
+                                           f"{bytes2human(size - done)} of padding")
+
+        return self.request(lambda conn: self.complete_upload(fname, handle, ul_key, mac_str))
+
+
+    def upload_stream_to_cloud(self, fname: str = '', stream: object = None, size: int = 0) -> bool:
+        """
+        uploading of stream with declared size to cloud directory as file fname,
+        the same file (by ledger, by name and declared size) is not uploaded twice
+        """
+
+        self.connect()
+        self.dir_id = None
+        if self.conn:
+            try:
+                self.dir_id = self.find_folder(self.dir_name)
+            except Exception as error:
+                self.log('connection to cloud', 'error', f"{self.pref_msg}Problem with connection to directory {self.dir_name}: {error}")
+        if not self.dir_id: return False
+        #------------------------------------------------------------------------------------------------------------------------------
+        if self.free_space() < size:
+            self.log('storage size checking', 'error',\
+                     f"{self.pref_msg}There are necessary additional space for this file: {bytes2human(self.dir_size)} against {bytes2human(size)}")
+            return False
+        node = self.check_ledger(fname, size)
+        if node:
+            self.stat_info = node
+            self.log("file uploading", 'info', f"{self.pref_msg}File {fname} already uploaded into {self.dir_name}, node: {node['f'][0]['h']}")
+            return True
+        #------------------------------------------------------------------------------------------------------------------------------
+        try:
+            self.stat_info = self.upload_stream(fname, stream, size)
+            self.update_ledger(fname, size, None, self.stat_info)
+            self.nodes().add(dict(self.stat_info['f'][0], a = {'n':fname}))
+            self.session['free'] -= size
+            self.log("file uploading", 'info', f"{self.pref_msg}Success with uploading stream {fname}, size: {bytes2human(size)}")
+            return True
+        except Exception as error:
+            self.log('file uploading', 'error', f"{self.pref_msg}Unexpected error during stream ({fname}) uploading : {error}")
+
+        return False
+
+
     def upload_file_to_cloud(self, fpath: str = '') -> bool:
         """
-        uploading file to cloud directory
+        uploading file to cloud directory,
+        the same file (by ledger) is not uploaded twice - self.stat_info holds the existing node
         """
         
         if os.path.isfile(fpath):
@@ -327,21 +810,34 @@ class Cloudmega:
         #-------------------------------------------------------------------------------------------------------------------------------
         if self.conn:
             try:
-                self.dir_id, _ = self.conn.find(self.dir_name)
+                self.dir_id = self.find_folder(self.dir_name)
             except Exception as error:
                 self.log('connection to cloud', 'error', f"{self.pref_msg}Problem with connection to directory {self.dir_name}: {error}")
         #-------------------------------------------------------------------------------------------------------------------------------
         if self.dir_id:
             ### Checking file size and comparing with storage#############################################################################
             sfile_before = os.path.getsize(fpath)
-            if self.dir_size < sfile_before:
+            if self.free_space() < sfile_before:
                 self.log('storage size checking', 'error',\
                          f"{self.pref_msg}There are necessary additional space for this file: {bytes2human(self.dir_size)} against {bytes2human(sfile_before)}")
                 return False
+            ### checking file in ledger of uploaded files ###############################################################################
+            fname, sha = os.path.basename(fpath), file_hash(fpath) if self.ledger else None
+            node = self.check_ledger(fname, sfile_before, sha)
+            if node:
+                self.stat_info = node
+                self.log("file uploading", 'info', f"{self.pref_msg}File {fname} already uploaded into {self.dir_name}, node: {node['f'][0]['h']}")
+                return True
             else:
                 ### uploading file to storage ############################################################################################
                 try:
-                    self.stat_info = self.conn.upload(fpath, self.dir_id)
+                    if self.checkpoints and sfile_before >= self.chunked_min_bytes:
+                        self.stat_info = self.request(lambda conn: self.upload_chunked(fpath, sha))
+                    else:
+                        self.stat_info = self.request(lambda conn: conn.upload(fpath, self.dir_id))
+                    self.update_ledger(fname, sfile_before, sha, self.stat_info)
+                    self.nodes().add(dict(self.stat_info['f'][0], a = {'n':fname}))
+                    self.session['free'] -= sfile_before
                     sfile_after = self.json_extract(self.stat_info, 's')[0]
                     if sfile_before == sfile_after: 
                         self.log("file uploading", 'info', f"{self.pref_msg}Success with uploading {fpath.split('/')[-1]}, size: {bytes2human(sfile_after)}")
@@ -363,6 +859,16 @@ class Cloudmega:
             self.conn = None
 
 
+### connection pools of redis by (host, port, db, password) and keys of static values
+### which are already written by the process - shared by all instances of DBredis
+redis_pools = {}
+redis_initialized = set()
+redis_pools_lock = threading.Lock()
+
+### script for leases: the lease is released only by its owner
+lua_release_lease = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+
+
 class DBredis:
     """
     Redis message Broker class.
@@ -389,7 +895,6 @@ class DBredis:
         self.dc_result = {}
         self.df_result = pd.DataFrame()
         self.pref_msg = ''
-        self.log_levels = ["debug", "info", "warn", "error"]
         self.format_dt = '%Y-%m-%d %H:%M:%S'
         self.logger = None
         self.conn = None
@@ -403,41 +908,39 @@ class DBredis:
         data - some key-value pairs for additional data of logging
         """
 
-        if self.log_levels.index(log_level) >= self.log_levels.index(log_level) and self.logger:
-            log_info = {
-                "level": log_level,
-                "time": datetime.now(timezone.utc).isoformat(),
-                "tag": tag,
-                "message": message,
-            }
-            log_info.update(data)
-            
-            if log_level == 'info': self.logger.info(json.dumps(log_info, cls=NpEncoder))
-            elif log_level == 'debug':self.logger.debug(json.dumps(log_info, cls=NpEncoder))
-            elif log_level == 'warn': self.logger.warn(json.dumps(log_info, cls=NpEncoder))
-            elif log_level == 'error':self.logger.error(json.dumps(log_info, cls=NpEncoder))
+        log(self.logger, tag, log_level, message, data)
 
 
     def connect_broker(self):
         """
-        Connect to a Kafka broker as Producer.
+        Connect to a Redis broker by the pool of process.
         """
                 
         if self.conn is None and not all([self.user, self.password]):
             try:
-                self.conn = redis.StrictRedis(
-                                    host=self.host,
-                                    port=self.port,
-                                    db=self.topic,
-                                    decode_responses=True,
-                                    charset='utf-8',
-                                    password=self.password,
-                                    )
-                if self.timezone:
-                    self.conn.set('timezone', self.timezone)
-                if self.headers != {}:
+                pool_key = (self.host, self.port, self.topic, self.password)
+                with redis_pools_lock:
+                    if pool_key not in redis_pools:
+                        redis_pools[pool_key] = redis.ConnectionPool(
+                                                    host=self.host,
+                                                    port=self.port,
+                                                    db=self.topic,
+                                                    decode_responses=True,
+                                                    encoding='utf-8',
+                                                    password=self.password,
+                                                    )
+                self.conn = redis.StrictRedis(connection_pool = redis_pools[pool_key])
+                #---------------------------------------------------------------------------------------------
+                ### static keys are written once by process
+                static_key = (pool_key, self.timezone, json.dumps(self.headers, sort_keys = True, cls = NpEncoder))
+                if static_key not in redis_initialized:
+                    pipe = self.conn.pipeline(transaction = False)
+                    if self.timezone:
+                        pipe.set('timezone', self.timezone)
                     for k,v in self.headers.items():
-                        _ = self.conn.set(k, self.change_format_to_str(v))
+                        pipe.set(k, self.change_format_to_str(v))
+                    pipe.execute()
+                    redis_initialized.add(static_key)
                     
             except Exception as error:
                 self.log('connection to broker', 'error', f"{self.pref_msg}Connection to Broker {self.host}: {error}")
@@ -478,6 +981,163 @@ class DBredis:
         return load
 
 
+    def acquire_lease(self, key, token, ttl: int = 120) -> bool:
+        """
+        atomic taking of lease (SET NX with ttl) by one round trip
+        """
+
+        load = False
+        self.connect_broker()
+        if self.conn:
+            try:
+                load = bool(self.conn.set(key, token, nx = True, ex = ttl))
+            except Exception as error:
+                self.log('lease in broker', 'error', f"Taking lease {key} in topic {self.topic}: {error}")
+        #-------------------------------------------------------------------------------------------------------
+        self.close()
+
+        return load
+
+
+    def release_lease(self, key, token) -> bool:
+        """
+        releasing of lease by its owner
+        """
+
+        load = False
+        self.connect_broker()
+        if self.conn:
+            try:
+                load = bool(self.conn.eval(lua_release_lease, 1, key, token))
+            except Exception as error:
+                self.log('lease in broker', 'error', f"Releasing lease {key} in topic {self.topic}: {error}")
+        #-------------------------------------------------------------------------------------------------------
+        self.close()
+
+        return load
+
+
+    def publish_messages(self, messages: dict = {}) -> bool:
+        """
+        publishing of several key-value pairs to Broker by one round trip
+        """
+
+        load = False
+        self.connect_broker()
+        if self.conn and messages != {}:
+            try:
+                pipe = self.conn.pipeline(transaction = False)
+                for key, value in messages.items():
+                    pipe.setex(key, self.retention_period, self.change_format_to_str(value))
+                load = all(pipe.execute())
+            except Exception as error:
+                self.log('publishing to broker', 'error', f"Publishing messages to topic {self.topic}: {error}")
+        #-------------------------------------------------------------------------------------------------------
+        self.close()
+
+        return load
+
+
+    def reading_messages(self, keys: list = []) -> dict:
+        """
+        reading of several keys from que by one round trip
+        """
+
+        self.connect_broker()
+        self.dc_result = {key:None for key in keys}
+        if self.conn and keys != []:
+            try:
+                self.dc_result = {k:self.change_format_to_str(v) for k,v in zip(keys, self.conn.mget(keys))}
+            except Exception as error:
+                self.log('consuming from broker', 'error', f"reading messages ({keys}) from topic {self.topic}: {error}")
+        #-------------------------------------------------------------------------------------------------------------
+        self.close()
+
+        return self.dc_result
+
+
+    def client(self) -> object:
+        """
+        client of redis on the pool of process for series of commands (it is not closed by instance)
+        """
+
+        self.connect_broker()
+        conn, self.conn = self.conn, None
+
+        return conn
+
+
+    def pipeline(self) -> object:
+        """
+        pipeline of commands for batches, connection is returned to pool after execute()
+        """
+
+        self.connect_broker()
+
+        return self.conn.pipeline(transaction = False) if self.conn else None
+
+
+    def publish_fields(self, name, mapping: dict = {}, ttl: int = None) -> bool:
+        """
+        publishing fields of hash to Broker,
+        ttl - retention of hash in seconds (without expiration by default)
+        """
+
+        load = False
+        self.connect_broker()
+        if self.conn and mapping != {}:
+            try:
+                pipe = self.conn.pipeline(transaction = False)
+                pipe.hset(name, mapping = {k:self.change_format_to_str(v) for k,v in mapping.items()})
+                if ttl: pipe.expire(name, ttl)
+                load = pipe.execute()[0] >= 0
+            except Exception as error:
+                self.log('publishing to broker', 'error', f"Publishing fields of {name} to topic {self.topic}: {error}")
+        #-------------------------------------------------------------------------------------------------------
+        self.close()
+
+        return load
+
+
+    def delete_message(self, key) -> bool:
+        """
+        deleting of key from Broker
+        """
+
+        load = False
+        self.connect_broker()
+        if self.conn:
+            try:
+                load = self.conn.delete(key) > 0
+            except Exception as error:
+                self.log('deleting from broker', 'error', f"Deleting {key} from topic {self.topic}: {error}")
+        #-------------------------------------------------------------------------------------------------------
+        self.close()
+
+        return load
+
+
+    def reading_fields(self, name, fields: list = []) -> dict:
+        """
+        fields of hash from que (all fields if they are not specified)
+        """
+
+        self.connect_broker()
+        self.dc_result = {}
+        if self.conn:
+            try:
+                if fields == []:
+                    self.dc_result = self.conn.hgetall(name)
+                else:
+                    self.dc_result = dict(zip(fields, self.conn.hmget(name, fields)))
+            except Exception as error:
+                self.log('consuming from broker', 'error', f"reading fields of {name} from topic {self.topic}: {error}")
+        #-------------------------------------------------------------------------------------------------------------
+        self.close()
+
+        return self.dc_result
+
+
     def reading_message(self, key, temp_dc = {}) -> dict:
         """
         messages from que for transform to dict
@@ -504,15 +1164,55 @@ class DBredis:
 
     
     def close(self):
+        """
+        connection is returned to the pool of process
+        """
 
         if self.conn:
             self.conn.close()
             self.conn = None
 
+class LeaseHeartbeat(threading.Thread):
+    """
+    renewing of lease from the running task (every third of ttl) until it is stopped,
+    redisdb - own instance with method renew_lease for the thread (FairScheduler or DiskBudget)
+    """
+
+    def __init__(self, 
+                redisdb: object = None, 
+                key: str = '', 
+                token: str = '', 
+                ttl: int = 120, 
+                logger: object = None):
+
+        super(LeaseHeartbeat, self).__init__(daemon = True)
+        self.redisdb = redisdb
+        self.key = key
+        self.token = token
+        self.ttl = ttl
+        self.logger = logger
+        self.stopped = threading.Event()
+
+
+    def run(self):
+
+        while not self.stopped.wait(self.ttl / 3):
+            if not self.redisdb.renew_lease(self.key, self.token, self.ttl):
+                log(self.logger, 'lease heartbeat', 'warn', f"Lease {self.key} is lost")
+
+
+    def stop(self):
+
+        self.stopped.set()
+
 ####################################################################################################
 #### engine of execution
 ####################################################################################################
 
+### bitrates of audio which are allowed in requests
+bitrates = ['320', '256', '192', '128', '96', '64']
+
+
 class AppEngine:
 
     def __init__(self,
@@ -524,7 +1224,8 @@ class AppEngine:
                 uncorrect: bool = False,
                 logger: object = None,
                 request: object = None,
-                redisdb: object = None):
+                redisdb: object = None,
+                scheduler: object = None):
 
         self.authorized = authorized
         self.queue_free = queue_free
@@ -534,7 +1235,6 @@ class AppEngine:
         self.token_task = ''
         self.set_cookie = set_cookie
         self.uncorrect = uncorrect
-        self.log_levels = ["debug", "info", "warn", "error"]
         self.response = None
         self.key = ''
         self.delcook = False
@@ -543,6 +1243,7 @@ class AppEngine:
         self.logger = logger
         self.redisdb = redisdb
         self.token_name = ''
+        self.scheduler = scheduler
 
     
     def log(self, tag: str = 'app', log_level: str = 'info', message: str = '', data: dict = {}):
@@ -553,19 +1254,7 @@ class AppEngine:
         data - some key-value pairs for additional data of logging
         """
 
-        if self.log_levels.index(log_level) >= self.log_levels.index(log_level) and self.logger:
-            log_info = {
-                "level": log_level,
-                "time": datetime.now(timezone.utc).isoformat(),
-                "tag": tag,
-                "message": message,
-            }
-            log_info.update(data)
-            
-            if log_level == 'info': self.logger.info(json.dumps(log_info, cls=NpEncoder))
-            elif log_level == 'debug':self.logger.debug(json.dumps(log_info, cls=NpEncoder))
-            elif log_level == 'warn': self.logger.warn(json.dumps(log_info, cls=NpEncoder))
-            elif log_level == 'error':self.logger.error(json.dumps(log_info, cls=NpEncoder))
+        log(self.logger, tag, log_level, message, data)
 
 
     def auth_process(self, token_name: str = 'token', token: str = '', main_page: bool = True):
@@ -596,13 +1285,31 @@ class AppEngine:
 
 
     def check_status(self):
+        """
+        the queue of user is free while it has place for pending jobs
+        """
 
         try:
-            msg = self.redisdb.reading_message(self.key)
-            self.queue_free = True if str(msg[self.key]) in ['None','free','0'] else False
-            self.log('parsing redis', 'info', f"Parsing redis '{self.key}': {msg}")
+            pending = self.scheduler.pending(self.int_token)
+            self.queue_free = pending < self.scheduler.max_pending
+            self.log('parsing redis', 'info', f"Pending jobs of '{self.key}': {pending}")
         except Exception as err:
             self.log('checking redis', 'error', f"Parsing redis: {err}")
+
+
+    def enqueue_job(self):
+        """
+        adding of job into the queue of user for fair scheduling (one round trip),
+        the queue is not free if it is full
+        """
+
+        self.params_task['user'] = self.int_token
+        self.params_task['job'] = make_guid(self.key, datetime.now(), random.randint(0, 10**6))
+        try:
+            self.queue_free = self.scheduler.enqueue(self.int_token, self.params_task)
+            self.log('queue of user', 'info', f"Job {self.params_task['job']} of '{self.key}' is queued: {self.queue_free}")
+        except Exception as err:
+            self.log('queue of user', 'error', f"Adding job into queue: {err}")
     
 
     def check_repeat_process(self, token_name: str = 'task_id', token: str = ''):
@@ -661,6 +1368,8 @@ class AppEngine:
             'translit':True,
             'bitrate':'96',
             'kind':'',
+            'offset':0,
+            'limit':None,
         }
         #-----------------------------------------------
         try:
@@ -690,12 +1399,47 @@ class AppEngine:
             self.params_task['links'] = [self.request.form[f'link_{i}'] for i in range(1,10) if f'link_{i}' in self.request.form.keys()]
             self.params_task['links'] = [x for x in self.params_task['links'] if x != '' and x.startswith('http')]
             if self.params_task['links'] == []: self.uncorrect = True
+
+            ### parsing range of playlists and channels : offset and max count of links
+            self.params_task['offset'] = max(0, int(self.request.form.get('offset') or 0))
+            self.params_task['limit'] = max(0, int(self.request.form.get('limit') or 0)) or None
             
             #-------------------------------------------
             self.parse_post = True
         except Exception as err:
             self.log('parsing POST params', 'error', f"Parsing POST: {err}")
     
+
+    def parse_json_params(self, cloud_path: str = 'temp', max_links: int = 1000):
+        """
+        Parsing JSON body of API request:
+        {"links": [url or {"url", "bitrate", "folder"}, ...], "bitrate": default, "folder": default}
+        """
+
+        self.params_task = {
+            'kind':'youtube',
+            'links':[],
+        }
+        #-----------------------------------------------
+        try:
+            body = self.request.get_json(force = True, silent = True) or {}
+            bitrate, folder = str(body.get('bitrate', '320')), body.get('folder') or cloud_path
+            #-------------------------------------------
+            for item in body.get('links', [])[:max_links + 1]:
+                item = {'url':item} if isinstance(item, str) else dict(item)
+                self.params_task['links'].append({
+                    'url':str(item.get('url', '')),
+                    'bitrate':str(item.get('bitrate') or bitrate),
+                    'fpath':item.get('folder') or folder,
+                })
+            #-------------------------------------------
+            links = self.params_task['links']
+            self.uncorrect = links == [] or len(links) > max_links or \
+                             not all([x['url'].startswith('http') and x['bitrate'] in bitrates for x in links])
+            self.parse_post = True
+        except Exception as err:
+            self.log('parsing JSON params', 'error', f"Parsing JSON: {err}")
+
 ####################################################################################################
 #### additional procedures 
 #####################################################################################################
@@ -708,77 +1452,113 @@ def make_guid(*args) -> str:
     return str(uuid.uuid5(uuid.NAMESPACE_OID, '-'.join(map(str, args))))
 
 
+def file_hash(fpath: str = '', chunk_size: int = 1024**2) -> str:
+    """
+    sha256 of file content
+    """
+
+    sha = hashlib.sha256()
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    
+    return sha.hexdigest()
+
+
+### tables for transliting from cyrilic to english words (built once per process) ###############################################
+upper_case_letters = {
+    u'А': u'A', u'Б': u'B', u'В': u'V', u'Г': u'G', u'Д': u'D', u'Е': u'E', u'Ё': u'E', u'Ж': u'Zh', u'З': u'Z',
+    u'И': u'I', u'Й': u'Y', u'К': u'K', u'Л': u'L', u'М': u'M', u'Н': u'N', u'О': u'O', u'П': u'P', u'Р': u'R',
+    u'С': u'S', u'Т': u'T', u'У': u'U', u'Ф': u'F', u'Х': u'H', u'Ц': u'Ts', u'Ч': u'Ch', u'Ш': u'Sh', u'Щ': u'Sch',
+    u'Ъ': u'', u'Ы': u'Y', u'Ь': u'', u'Э': u'E', u'Ю': u'Yu', u'Я': u'Ya',
+}
+#-----------------------------------------------------------------------------------------------------------------------------------
+lower_case_letters = {
+    u'а': u'a', u'б': u'b', u'в': u'v', u'г': u'g', u'д': u'd', u'е': u'e', u'ё': u'yo', u'ж': u'zh', u'з': u'z',
+    u'и': u'i', u'й': u'y', u'к': u'k', u'л': u'l', u'м': u'm', u'н': u'n', u'о': u'o', u'п': u'p', u'р': u'r',
+    u'с': u's', u'т': u't', u'у': u'u', u'ф': u'f', u'х': u'h', u'ц': u'ts', u'ч': u'ch', u'ш': u'sh', u'щ': u'sch',
+    u'ъ': u'', u'ы': u'y', u'ь': u'', u'э': u'e', u'ю': u'yu', u'я': u'ya',
+}
+### tables for transliting from english to cyrilic words ###########################################################################
+rev_upper_case_letters = {
+    'A': 'А','B': 'Б', 'V': 'В', 'G': 'Г', 'D': 'Д', 'E': 'Э', 'Z': 'З', 'I': 'И', 'Y': 'Ы', 'K': 'К','L': 'Л',
+    'M': 'М', 'N': 'Н', 'O': 'О', 'P': 'П', 'R': 'Р', 'S': 'С', 'T': 'Т', 'U': 'У', 'F': 'Ф', 'H': 'Х','J':'Дж',
+}
+#-----------------------------------------------------------------------------------------------------------------------------------
+rev_lower_case_letters = {
+    'a': 'а', 'b': 'б', 'v': 'в', 'g': 'г', 'd': 'д', 'e': 'э', 'z': 'з', 'i': 'и', 'y': 'ы', 'k': 'к','l': 'л',
+    'm': 'м', 'n': 'н', 'o': 'о', 'p': 'п', 'r': 'р', 's': 'с', 't': 'т', 'u': 'у', 'f': 'ф', 'h': 'х','j':'дж',
+}
+#-----------------------------------------------------------------------------------------------------------------------------------
+rev_pairs = {
+    'Zh': 'Ж','Ts': 'Ц','Ch': 'Ч','Sh': 'Ш', 'Sch': 'Щ', 'Yu': 'Ю', 'Ya': 'Я','Yo': 'Ё','yo': 'ё', 'zh': 'ж','ts': 'ц',
+    'ch': 'ч', 'sh': 'ш', 'sch': 'щ', 'yu': 'ю', 'ya': 'я','a ':'','A ':'','An ':'','an ':'','The ':'','the ':'', 'of ':'',
+    'Of ':'','To ':'к ','to ':'к ','On ':'на ','on ':'на ','in ':'в','In ':'в ','is ':'','Is ':'','are ':'','Are ':'',
+}
+### the upper letter with two or three latin letters is written in upper case if the next letter is not lower cyrillic
+re_upper_pairs = re.compile('([%s])(?![%s])' % (
+    ''.join([k for k, v in upper_case_letters.items() if len(v) > 1]),
+    ''.join(lower_case_letters.keys())))
+re_cjk = re.compile(u'[\u4E00-\u9FA5]')
+translit_table = str.maketrans({**upper_case_letters, **lower_case_letters})
+
+### sanitizer of names of files = clean_string -> translit -> strip_non_english -> replace(' ', '_')
+### the symbols removed by clean_string are skipped by look-ahead, so context of upper letters is the same
+re_sanitize_pairs = re.compile('([%s])(?![!@#«$»]*[%s])' % (
+    ''.join([k for k, v in upper_case_letters.items() if len(v) > 1]),
+    ''.join(lower_case_letters.keys())))
+sanitize_table = str.maketrans({
+    **upper_case_letters,
+    **lower_case_letters,
+    **{c:None for c in '!@#«$»'},
+    **{chr(c):None for c in range(0x4E00, 0x9FA6)},
+    '&':'and',
+    ' ':'_',
+})
+
+
+def sanitize(s: str = '') -> str:
+    """
+    name of file with only english letters (the same as chain of clean_string, translit,
+    strip_non_english and replacing spaces by '_') by one pass of compiled tables
+    """
+
+    return re_sanitize_pairs.sub(lambda m: upper_case_letters[m.group(1)].upper(), s).translate(sanitize_table)
+
+
+def sanitize_many(names: list = []) -> list:
+    """
+    sanitizing of batch of names
+    """
+
+    sub, table = re_sanitize_pairs.sub, sanitize_table
+    upper = lambda m: upper_case_letters[m.group(1)].upper()
+
+    return [sub(upper, s).translate(table) for s in names]
+
+
 def translit(s: str = '', rev: bool = False) -> str:
     """ Make translit the words in both ways (from cyrillic to english)"""
     
-    ### dicts for transliting from cyrilic to english words #######################################################################
-    upper_case_letters = {
-        u'А': u'A', u'Б': u'B', u'В': u'V', u'Г': u'G', u'Д': u'D', u'Е': u'E', u'Ё': u'E', u'Ж': u'Zh', u'З': u'Z',
-        u'И': u'I', u'Й': u'Y', u'К': u'K', u'Л': u'L', u'М': u'M', u'Н': u'N', u'О': u'O', u'П': u'P', u'Р': u'R',
-        u'С': u'S', u'Т': u'T', u'У': u'U', u'Ф': u'F', u'Х': u'H', u'Ц': u'Ts', u'Ч': u'Ch', u'Ш': u'Sh', u'Щ': u'Sch',
-        u'Ъ': u'', u'Ы': u'Y', u'Ь': u'', u'Э': u'E', u'Ю': u'Yu', u'Я': u'Ya',
-    }
-    #-------------------------------------------------------------------------------------------------------------------------------
-    lower_case_letters = {
-        u'а': u'a', u'б': u'b', u'в': u'v', u'г': u'g', u'д': u'd', u'е': u'e','ё':u'yo', u'ё': u'yo', u'ж': u'zh', u'з': u'z',
-        u'и': u'i', u'й': u'y', u'к': u'k', u'л': u'l', u'м': u'm', u'н': u'n', u'о': u'o', u'п': u'p', u'р': u'r',
-        u'с': u's', u'т': u't', u'у': u'u', u'ф': u'f', u'х': u'h', u'ц': u'ts', u'ч': u'ch', u'ш': u'sh', u'щ': u'sch',
-        u'ъ': u'', u'ы': u'y', u'ь': u'', u'э': u'e', u'ю': u'yu', u'я': u'ya',
-    }    
-    ### dicts for transliting from english to cyrilic words #######################################################################
-    rev_upper_case_letters = {
-        'A': 'А','B': 'Б', 'V': 'В', 'G': 'Г', 'D': 'Д', 'E': 'Э', 'Z': 'З', 'I': 'И', 'Y': 'Ы', 'K': 'К','L': 'Л',
-        'M': 'М', 'N': 'Н', 'O': 'О', 'P': 'П', 'R': 'Р', 'S': 'С', 'T': 'Т', 'U': 'У', 'F': 'Ф', 'H': 'Х','J':'Дж',
-    }
-    #-------------------------------------------------------------------------------------------------------------------------------
-    rev_lower_case_letters = {
-        'a': 'а', 'b': 'б', 'v': 'в', 'g': 'г', 'd': 'д', 'e': 'э', 'z': 'з', 'i': 'и', 'y': 'ы', 'k': 'к','l': 'л',
-        'm': 'м', 'n': 'н', 'o': 'о', 'p': 'п', 'r': 'р', 's': 'с', 't': 'т', 'u': 'у', 'f': 'ф', 'h': 'х','j':'дж',
-    }
-    #-------------------------------------------------------------------------------------------------------------------------------
-    pairs = {
-        'Zh': 'Ж','Ts': 'Ц','Ch': 'Ч','Sh': 'Ш', 'Sch': 'Щ', 'Yu': 'Ю', 'Ya': 'Я','Yo': 'Ё','yo': 'ё', 'zh': 'ж','ts': 'ц',
-        'ch': 'ч', 'sh': 'ш', 'sch': 'щ', 'yu': 'ю', 'ya': 'я','a ':'','A ':'','An ':'','an ':'','The ':'','the ':'', 'of ':'',
-        'Of ':'','To ':'к ','to ':'к ','On ':'на ','on ':'на ','in ':'в','In ':'в ','is ':'','Is ':'','are ':'','Are ':'',
-    }
-    ################################################################################################################################
-    
-    translit_string = ""
-    #------------------------------------------------------------------------------------------------------------------------------
     if not rev:
-        for index, char in enumerate(s):
-            if char in lower_case_letters.keys():
-                char = lower_case_letters[char]
-            elif char in upper_case_letters.keys():
-                char = upper_case_letters[char]
-                if len(s) > index+1:
-                    if s[index+1] not in lower_case_letters.keys():
-                        char = char.upper()
-                else:
-                    char = char.upper()
-            #---------------------------------------------------
-            translit_string += char
-    #--------------------------------------------------------------------------------------------------------------------------------
-    else:
-        for i in pairs.keys():
-            if i in string:
-                s = s.replace(i, pairs[i])
-        #--------------------------------------------------------
-        for index, char in enumerate(s):
-            if char in rev_lower_case_letters.keys():
-                char = rev_lower_case_letters[char]
-            elif char in rev_upper_case_letters.keys():
-                char = rev_upper_case_letters[char]
-                if len(s) > index+1:
-                    if s[index+1] not in rev_lower_case_letters.keys():
-                        char = char.upper()
-                else:
-                    char = char.upper()
-            #------------------------------------------------------
-            translit_string += char
+        return re_upper_pairs.sub(lambda m: upper_case_letters[m.group(1)].upper(), s).translate(translit_table)
     #--------------------------------------------------------------------------------------------------------------------------------
+    for i in rev_pairs.keys():
+        if i in s:
+            s = s.replace(i, rev_pairs[i])
+    #--------------------------------------------------------
+    translit_string = []
+    for index, char in enumerate(s):
+        if char in rev_lower_case_letters:
+            char = rev_lower_case_letters[char]
+        elif char in rev_upper_case_letters:
+            char = rev_upper_case_letters[char]
+            if len(s) == index+1 or s[index+1] not in rev_lower_case_letters:
+                char = char.upper()
+        #------------------------------------------------------
+        translit_string.append(char)
     
-    return translit_string
+    return ''.join(translit_string)
 
 
 def clean_string(s: str = '') -> str:
@@ -809,6 +1589,4 @@ def strip_non_english(s: str = '') -> str:
     filtering other letters not from english
     """
     
-    en_list = re.findall(u'[^\u4E00-\u9FA5]', s)
-    
-    return ''.join(['' if c not in en_list else c for c in s])
\ No newline at end of file
+    return re_cjk.sub('', s)
\ No newline at end of file
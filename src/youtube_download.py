@@ -1,44 +1,407 @@
 from .utils import *
+import copy
+from types import MappingProxyType
+from contextlib import contextmanager
+from youtube_dl.postprocessor.common import PostProcessor
+from youtube_dl.extractor.youtube import YoutubeIE, YoutubeTabIE, YoutubePlaylistIE
 
 
 #####################################################################################################
-#### Youtube procedures 
+#### Youtube procedures
 #####################################################################################################
 
-def download_audio(url_list: list = [], path_to_save: str = '',num_trying: int = 2, **params_youtube) -> dict:
+class DownloadTracker(PostProcessor):
     """
-    main procedure for parsing audio content from youtube by using library youtube_dl
+    tracking of links in one instance of YoutubeDL:
+    the exact path of the final file (after all postprocessors) and timings of stages,
+    it is added as the last postprocessor and as progress hook of instance
     """
-    
-    res_path = {}   ## result dict
 
-    if not isinstance(url_list, list): url_list = [url_list]
-    params_youtube['outtmpl'] = os.path.join(path_to_save, '%(title)s.%(ext)s')
-    
-    #-------------------------------------------------------------------------
-    ydl = youtube_dl.YoutubeDL(params_youtube)
-    
-    for url in url_list:
-        res = {}
-        for _ in range(num_trying):
-            try:
-                res = ydl.extract_info(url)
-                if res != {}: break
-            except:
-                sleep(9)
-        #---------------------------------------------------------------------
-        if res == {} or 'title' not in res.keys(): 
-            res_path[url] = None
-            continue
+    def __init__(self, downloader: object = None, progress: object = None):
+        
+        super(DownloadTracker, self).__init__(downloader)
+        self.progress = progress
+        self.url = None
+        self.reset()
+
+
+    def reset(self):
+        """
+        preparing of tracker for the next link
+        """
+
+        self.fpath = None
+        self.timings = {'extract':0, 'download':0, 'postprocess':0}
+        self.marks = {'start':time(), 'download':None, 'postprocess':None}
+
+
+    def progress_hook(self, d: dict = {}):
+        """
+        marks of starting and finishing of downloading
+        """
+
+        if d.get('status') == 'downloading' and self.marks['download'] is None:
+            self.marks['download'] = time()
+        elif d.get('status') == 'finished':
+            ### already downloaded file is reported only by finishing
+            if self.marks['download'] is None: self.marks['download'] = time()
+            self.marks['postprocess'] = time()
+            self.fpath = d.get('filename', self.fpath)
         #---------------------------------------------------------------------
-        title = res['title'].translate(str.maketrans('', '', string.punctuation)).replace(' ','')
+        if self.progress: self.progress.download_hook(self.url, d)
+
+
+    def run(self, information: dict = {}) -> tuple:
+        """
+        the last postprocessor in chain - receives the final path of file
+        """
+
+        self.fpath = information.get('filepath', self.fpath)
         #---------------------------------------------------------------------
-        temp_ls = [x[0] for x in map(lambda x: [x, x.translate(str.maketrans('', '', string.punctuation)).replace(' ','')],\
-                                     os.listdir(path_to_save)) if title in x[1]]
-        if temp_ls == []:
-            res_path[url] = None
-        else:
-            res_path[url] = os.path.join(path_to_save, temp_ls[0])
+        finish = time()
+        download = self.marks['download'] or finish
+        postprocess = self.marks['postprocess'] or finish
+        self.timings = {
+            'extract':round(download - self.marks['start'], 3),
+            'download':round(postprocess - download, 3),
+            'postprocess':round(finish - postprocess, 3),
+            'bytes_saved':format_savings(information),
+        }
+
+        return [], information
+
+
+def audio_format(bitrate: str = '', fallback: str = 'bestaudio/best') -> str:
+    """
+    selector of format: the smallest audio stream with bitrate not lower than requested,
+    then the fallback (the best audio for bitrates above all of streams)
+    """
+
+    return f"worstaudio[abr>={int(bitrate)}]/{fallback}" if str(bitrate).isdigit() else fallback
+
+
+def format_savings(information: dict = {}) -> int:
+    """
+    bytes which are not downloaded by choosing of format against the best audio stream
+    """
+
+    size = lambda x: x.get('filesize') or x.get('filesize_approx') or 0
+    formats = [x for x in information.get('formats') or [] if x.get('vcodec') == 'none' and x.get('abr')]
+    if not formats or not size(information): return 0
+    best = max(formats, key = lambda x: x['abr'])
+
+    return max(0, size(best) - size(information))
+
+
+def video_id(url: str = '') -> str:
+    """
+    id of youtube video from link or None for other links
+    """
+
+    try:
+        return YoutubeIE._match_id(url) if YoutubeIE.suitable(url) else None
+    except:
+        return None
+
+
+def is_collection(url: str = '') -> bool:
+    """
+    link to playlist or channel of youtube (not to single video)
+    """
+
+    try:
+        return not YoutubeIE.suitable(url) and (YoutubeTabIE.suitable(url) or YoutubePlaylistIE.suitable(url))
+    except:
+        return False
+
+
+def entry_url(entry: dict = {}) -> str:
+    """
+    link of entry of flat extraction (entries of youtube are given by id of video)
+    """
+
+    url = entry.get('url') or entry.get('webpage_url') or ''
+    if entry.get('ie_key') == YoutubeIE.ie_key() and not url.startswith('http'):
+        return f"https://www.youtube.com/watch?v={entry.get('id') or url}"
+
+    return url
+
+
+def iter_collection(url: str = '', offset: int = 0, depth: int = 1):
+    """
+    lazy expansion of playlist or channel by flat extraction: generator of links of entries from offset,
+    the next pages of list are requested only when entries are taken (metadata of videos is not resolved),
+    depth - level of nested playlists (shelves of channel) which are expanded too
+    """
+
+    ydl = youtube_dl.YoutubeDL({'extract_flat':'in_playlist', 'quiet':True, 'skip_download':True})
+    info = ydl.extract_info(url, download = False, process = False) or {}
+    entries = info.get('entries') or [] if info.get('_type') in ('playlist', 'multi_video') else [info]
+    #---------------------------------------------------------------------------------------------
+    def links():
+        for entry in entries:
+            link = entry_url(entry or {})
+            if link == '' or link == url: continue
+            if is_collection(link):
+                if depth > 0: yield from iter_collection(link, 0, depth - 1)
+            else:
+                yield link
+
+    return islice(links(), offset, None)
+
+
+def expand_links(url_list: list = [], offset: int = 0, limit: int = None, progress: object = None, failed: list = None):
+    """
+    generator of links of job: single videos as they are and entries of playlists and channels
+    (from offset) as they are discovered, in total not more than limit,
+    links of playlists and channels which are failed to expand are added to failed
+    """
+
+    def links():
+        for url in url_list:
+            if not is_collection(url):
+                yield url
+                continue
+            #-------------------------------------------------------------------------------------
+            try:
+                yield from iter_collection(url, offset)
+            except Exception as error:
+                if progress: progress.update(url, 'error', message = str(error))
+                if failed is not None: failed.append(url)
+
+    return islice(links(), limit)
+
+
+def job_cost(url_list: list = [], limit: int = None) -> int:
+    """
+    expected count of links of job (playlist or channel costs as limit)
+    """
+
+    cost = sum([(limit or 1) if is_collection(url) else 1 for url in url_list])
+
+    return min(cost, limit) if limit else cost
+
+
+def freeze(value: object = None) -> object:
+    """
+    read-only copy of nested options (dicts as mapping proxies, lists as tuples)
+    """
+
+    if isinstance(value, dict):
+        return MappingProxyType({k:freeze(v) for k,v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+
+    return value
+
+
+### immutable option profiles of process by (base options, codec, bitrate, path)
+option_profiles = {}
+option_profiles_lock = threading.Lock()
+
+
+def option_profile(options: dict = {}, codec: str = None, bitrate: str = None, path_to_save: str = '') -> tuple:
+    """
+    immutable options of youtube_dl for (codec, bitrate) derived from base options (src/youtube.yaml),
+    as result - (key of profile, options), every profile is built once per process
+    """
+
+    extract = [x for x in options.get('postprocessors', []) if x.get('key') == 'FFmpegExtractAudio']
+    codec = codec or (extract[0]['preferredcodec'] if extract else None)
+    bitrate = str(bitrate or (extract[0]['preferredquality'] if extract else ''))
+    key = (json.dumps(options, sort_keys = True, default = str), codec, bitrate, path_to_save)
+    #---------------------------------------------------------------------------------------------
+    profile = option_profiles.get(key)
+    if profile is None:
+        params = copy.deepcopy(dict(options))
+        for pp in params.get('postprocessors', []):
+            if pp.get('key') == 'FFmpegExtractAudio':
+                pp['preferredcodec'], pp['preferredquality'] = codec, bitrate
+        ### own folder by job and video (job is given by extra_info of link): the same title of other videos,
+        ### the same video in concurrent jobs and sources of other bitrates do not share the path
+        params['outtmpl'] = os.path.join(path_to_save, '%(job)s', '%(id)s', '%(title)s.%(ext)s')
+        with option_profiles_lock:
+            profile = option_profiles.setdefault(key, freeze(params))
+
+    return key, profile
+
+
+def make_downloader(params_youtube: dict = {}, progress: object = None) -> tuple:
+    """
+    instance of YoutubeDL with attached tracker (and progress of job)
+    """
+
+    ydl = youtube_dl.YoutubeDL(params_youtube)
+    tracker = DownloadTracker(ydl, progress)
+    ydl.add_progress_hook(tracker.progress_hook)
+    ydl.add_post_processor(tracker)
+
+    return ydl, tracker
+
+
+class DownloaderPool:
+    """
+    ready instances of YoutubeDL (with trackers) by keys of option profiles,
+    the instance is used by one thread at the same time and is returned to the pool after job,
+    so the setup of extractors and postprocessors is done once per worker
+    """
+
+    def __init__(self, max_idle: int = 4):
+
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+
+
+    @contextmanager
+    def lease(self, key: tuple = (), profile: object = None, progress: object = None):
+        """
+        taking of instance for profile (or making of the new one) and returning it back
+        """
+
+        with self.lock:
+            items = self.idle.get(key)
+            item = items.pop() if items else None
+        if item is None:
+            item = make_downloader(profile)
+        #---------------------------------------------------------------------------------------------
+        ydl, tracker = item
+        tracker.progress, tracker.url = progress, None
+        try:
+            yield item
+        finally:
+            tracker.progress = None
+            with self.lock:
+                items = self.idle.setdefault(key, [])
+                if len(items) < self.max_idle: items.append(item)
+
+### instances of worker process
+downloaders = DownloaderPool()
+
+
+def download_link(ydl: object = None, tracker: object = None, url: str = '', num_trying: int = 2, meta: object = None,\
+                  extra_info: dict = None) -> tuple:
+    """
+    extracting of one link by instance of YoutubeDL,
+    meta - optional cache of metadata (MetaCache): the cached metadata is processed without extraction,
+    extra_info - fields of link for template of output (job),
+    as result - path to the file or None and timings of stages
+    """
+
+    res, tracker.url = {}, url
+    if tracker.progress: tracker.progress.update(url, 'extract')
+    for _ in range(num_trying):
+        tracker.reset()
+        information = meta.get(url) if meta else None
+        cached = information is not None
+        try:
+            if meta and video_id(url):
+                if information is None:
+                    information = ydl.extract_info(url, download = False, process = False)
+                    meta.put(url, information)
+                res = ydl.process_ie_result(information, download = True, extra_info = extra_info or {})
+            else:
+                res = ydl.extract_info(url, extra_info = extra_info or {})
+            if res != {}: break
+        except:
+            ### the links of formats in metadata could be expired - they are extracted again at once,
+            ### other failures are retried by caller later
+            if meta: meta.delete(url)
+            if not cached: break
+    #---------------------------------------------------------------------
+    if res == {} or res is None or tracker.fpath is None or not os.path.isfile(tracker.fpath):
+        return None, tracker.timings
+
+    return tracker.fpath, tracker.timings
+
+
+def stream_source(ydl: object = None, url: str = '', meta: object = None) -> dict:
+    """
+    the selected format of video for streaming without downloading (by cached metadata if it is possible),
+    as result - direct url of format with its headers, duration and name of file (with extension of source)
+    or None if the format is not one stream (formats to be merged) or its duration is unknown
+    """
+
+    information = meta.get(url) if meta else None
+    if information is None:
+        information = ydl.extract_info(url, download = False, process = False)
+        if meta: meta.put(url, information)
+    res = ydl.process_ie_result(information, download = False)
+    if not res or res.get('requested_formats') or not res.get('url') or not res.get('duration'):
+        return None
+
+    return {
+        'url':res['url'],
+        'headers':res.get('http_headers') or {},
+        'duration':res['duration'],
+        'fname':os.path.basename(ydl.prepare_filename(res)),
+    }
+
+
+def iter_download_audio(url_list: list = [], path_to_save: str = '', num_trying: int = 2, num_workers: int = 1,\
+                        progress: object = None, codec: str = None, bitrate: str = None, meta: object = None,\
+                        extra_info: dict = None, **params_youtube):
+    """
+    generator of (url, path_or_None, timings) in order of finishing of downloads,
+    url_list - list or iterator of links (it is taken lazily, by one link per finished one),
+    num_workers - max count of links in processing at the same time
+    (every worker takes own instance of YoutubeDL from the pool of process),
+    progress - optional JobProgress for reporting of stages by links,
+    codec, bitrate - profile of options (by default - from params_youtube),
+    meta - optional cache of metadata of videos,
+    extra_info - fields of links for template of output ({'job':...} - folder of job in path_to_save)
+    """
+
+    if isinstance(url_list, str): url_list = [url_list]
+    key, profile = option_profile(params_youtube, codec, bitrate, path_to_save)
+    num_workers = max(1, int(num_workers))
+    ### links could be given by generator (entries of playlists as they are discovered)
+    if hasattr(url_list, '__len__'): num_workers = max(1, min(num_workers, len(url_list)))
+
+    #-------------------------------------------------------------------------
+    if num_workers == 1:
+        with downloaders.lease(key, profile, progress) as (ydl, tracker):
+            for url in url_list:
+                yield (url, *download_link(ydl, tracker, url, num_trying, meta, extra_info))
+        return
+    #-------------------------------------------------------------------------
+    def worker(url):
+        with downloaders.lease(key, profile, progress) as (ydl, tracker):
+            return download_link(ydl, tracker, url, num_trying, meta, extra_info)
+    #-------------------------------------------------------------------------
+    ### next link is submitted only after the previous result was taken by caller,
+    ### so slow consumer holds the count of files in progress
+    urls, futures = iter(url_list), {}
+    with ThreadPoolExecutor(max_workers = num_workers) as pool:
+        for url in islice(urls, num_workers):
+            futures[pool.submit(worker, url)] = url
         #---------------------------------------------------------------------
-    
-    return res_path
\ No newline at end of file
+        while futures:
+            done, _ = wait(futures, return_when = FIRST_COMPLETED)
+            for future in done:
+                try:
+                    fpath, timings = future.result()
+                except:
+                    fpath, timings = None, {}
+                yield futures.pop(future), fpath, timings
+                #-------------------------------------------------------------
+                for url in islice(urls, 1):
+                    futures[pool.submit(worker, url)] = url
+
+
+def download_audio(url_list: list = [], path_to_save: str = '', num_trying: int = 2, num_workers: int = 1,\
+                   timings: dict = None, progress: object = None, codec: str = None, bitrate: str = None,\
+                   **params_youtube) -> dict:
+    """
+    main procedure for parsing audio content from youtube by using library youtube_dl,
+    timings - optional dict for timings of stages by every link
+    """
+
+    res_path = {}   ## result dict
+
+    for url, fpath, timing in iter_download_audio(url_list, path_to_save, num_trying, num_workers, progress,\
+                                                  codec, bitrate, **params_youtube):
+        res_path[url] = fpath
+        if timings is not None: timings[url] = timing
+
+    return res_path